@@ -6,13 +6,16 @@ Created on Tue Mar 19 10:11:04 2019
 @author: ckielasjensen
 """
 
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
 import matplotlib.pyplot as plt
 import numpy as np
 import scipy.optimize as sop
 import time
 
 import bezier as bez
-from optimization import BezOptimization
+from optimization import BezOptimization, finiteDiffJacobian
 
 if __name__ == '__main__':
     track1 = bez.Bezier([[0, 0, 0, 3, 4, 5, 6, 7, 10, 10, 10],
@@ -45,24 +48,40 @@ if __name__ == '__main__':
     infs.append(1e-3)
     bounds = sop.Bounds(np.array(infs), np.inf)
 
-    ineqCons = [{'type': 'ineq', 'fun': bezopt.maxSpeedConstraints},
-                {'type': 'ineq', 'fun': bezopt.maxAngularRateConstraints},
-                {'type': 'ineq', 'fun': bezopt.spatialSeparationConstraints}]
-
-    startTime = time.time()
-    results = sop.minimize(
-                bezopt.objectiveFunction,
-                x0=xGuess,
-                method='SLSQP',
-                constraints=ineqCons,
-                bounds=bounds,
-                options={'maxiter': 250,
-                         'disp': True,
-                         'iprint': 2}
-                )
-    endTime = time.time()
+    # The spatial separation has no analytic Jacobian and each evaluation runs
+    # the minimum distance algorithm, so the finite differences are split
+    # across processes.
+    with ProcessPoolExecutor() as executor:
+        spatialJac = partial(finiteDiffJacobian,
+                             bezopt.spatialSeparationConstraints,
+                             executor=executor)
+
+        ineqCons = [{'type': 'ineq',
+                     'fun': bezopt.maxSpeedConstraints,
+                     'jac': bezopt.maxSpeedConstraintsJac},
+                    {'type': 'ineq',
+                     'fun': bezopt.maxAngularRateConstraints,
+                     'jac': bezopt.maxAngularRateConstraintsJac},
+                    {'type': 'ineq',
+                     'fun': bezopt.spatialSeparationConstraints,
+                     'jac': spatialJac}]
+
+        startTime = time.time()
+        results = sop.minimize(
+                    bezopt.objectiveAndGradient,
+                    x0=xGuess,
+                    method='SLSQP',
+                    jac=True,
+                    constraints=ineqCons,
+                    bounds=bounds,
+                    options={'maxiter': 250,
+                             'disp': False,
+                             'ftol': 1e-4}
+                    )
+        endTime = time.time()
 
     print('---')
+    print(results.message)
     print('Computation Time: {}'.format(endTime - startTime))
     print('---')
 
@@ -79,7 +98,7 @@ if __name__ == '__main__':
     fig, ax = plt.subplots()
     curves = []
     for i in range(numVeh):
-        curves.append(bez.Bezier(cpts[i*dim:(i+1)*dim]))
+        curves.append(bez.Bezier(cpts[i]))
     for curve in curves:
         plt.plot(curve.curve[0], curve.curve[1], '-',
                  curve.cpts[0], curve.cpts[1], '.--')
@@ -15,6 +15,68 @@ import time
 import bezier as bez
 from optimization import BezOptimization
 
+try:
+    from cyipopt import minimize_ipopt
+except ImportError:
+    minimize_ipopt = None
+
+
+def solve(bezopt, x0, constraints, maxiter=250, history=None):
+    """Solves the time optimal problem
+
+    IPOPT is used when cyipopt is installed since its interior point method
+    with limited memory quasi-Newton updates handles the many inequality
+    constraints better than SLSQP. Otherwise SciPy's SLSQP is used.
+
+    :param bezopt: Optimization problem
+    :type bezopt: BezOptimization
+    :param x0: Initial guess
+    :type x0: numpy.ndarray
+    :param constraints: Nonlinear constraints of the problem. The final time
+        is always constrained to be non negative.
+    :type constraints: list(scipy.optimize.NonlinearConstraint)
+    :param maxiter: Maximum number of iterations
+    :type maxiter: int
+    :param history: If not None, the objective value of each iteration is
+        appended to this list rather than printing it while solving.
+    :type history: list or None
+    :return: Result of the optimization
+    :rtype: scipy.optimize.OptimizeResult
+    """
+    numVars = x0.size
+
+    if history is None:
+        callback = None
+    else:
+        def callback(xk, *args):
+            history.append(bezopt.objectiveFunction(xk))
+
+    if minimize_ipopt is not None:
+        ipoptCons = [{'type': 'ineq', 'fun': cons.fun, 'jac': cons.jac}
+                     for cons in constraints]
+        bounds = [(None, None)]*(numVars-1) + [(0, None)]
+        return minimize_ipopt(bezopt.objectiveAndGradient,
+                              x0=x0,
+                              jac=True,
+                              constraints=ipoptCons,
+                              bounds=bounds,
+                              callback=callback,
+                              options={'max_iter': maxiter,
+                                       'print_level': 0,
+                                       'hessian_approximation':
+                                           'limited-memory'})
+
+    tfCons = sop.LinearConstraint(np.eye(1, numVars, numVars-1), 0, np.inf)
+    return sop.minimize(bezopt.objectiveAndGradient,
+                        x0=x0,
+                        method='SLSQP',
+                        jac=True,
+                        constraints=constraints + [tfCons],
+                        callback=callback,
+                        options={'maxiter': maxiter,
+                                 'disp': False,
+                                 'ftol': 1e-4})
+
 
 def animateTrajectory(trajectories):
     """Animates the trajectories
@@ -22,31 +84,32 @@ def animateTrajectory(trajectories):
     """
     global ani
 
-    curveLen = len(trajectories[0].curve[0])
+    # Evaluate each trajectory once and share the points between the plotted
+    # paths and every frame of the animation
+    points = np.stack([traj.curve for traj in trajectories])
+    curveLen = points.shape[2]
+    # Frames go forwards along the curve and then back to the start
+    frameIdx = np.concatenate((np.arange(curveLen),
+                               np.arange(curveLen-1, -1, -1)))
     fig, ax = plt.subplots()
-    [ax.plot(traj.curve[0], traj.curve[1], '-', lw=3) for traj in trajectories]
-    lines = [ax.plot([], [], 'o', markersize=20)[0] for traj in trajectories]
+    colors = [ax.plot(pts[0], pts[1], '-', lw=3)[0].get_color()
+              for pts in points]
+    # All of the vehicles are drawn by a single collection so that each frame
+    # only needs one update
+    vehicles = ax.scatter([], [], s=400, c=colors)
 
     def init():
-        for line in lines:
-            line.set_data([], [])
-        return lines
+        vehicles.set_offsets(np.empty((0, 2)))
+        return [vehicles]
 
     def animate(frame):
-        for i, line in enumerate(lines):
-            traj = trajectories[i]
-            try:
-                line.set_data(traj.curve[0][frame],
-                              traj.curve[1][frame])
-            except IndexError:
-                line.set_data(traj.curve[0][curveLen-frame-1],
-                              traj.curve[1][curveLen-frame-1])
-        return lines
+        vehicles.set_offsets(points[:, :, frameIdx[frame]])
+        return [vehicles]
 
     plt.axis('off')
     ani = animation.FuncAnimation(fig,
                                   animate,
-                                  len(trajectories[0].curve[0])*2,
+                                  frameIdx.size,
                                   init_func=init,
                                   interval=10,
                                   blit=True,
@@ -78,44 +141,44 @@ if __name__ == '__main__':
                              )
 
     xGuess = bezopt.generateGuess(std=0)
-    ineqCons = [{'type': 'ineq', 'fun': bezopt.temporalSeparationConstraints},
-                {'type': 'ineq', 'fun': bezopt.maxSpeedConstraints},
-                {'type': 'ineq', 'fun': bezopt.maxAngularRateConstraints},
-                {'type': 'ineq', 'fun': lambda x: x[-1]}]
-
-    _ = bez.Bezier(bezopt.reshapeVector(xGuess))
-    _.elev(10)
-    _ = _*_
-
+    ineqCons = [sop.NonlinearConstraint(
+                    bezopt.temporalSeparationConstraints, 0, np.inf,
+                    jac=bezopt.temporalSeparationConstraintsJac),
+                sop.NonlinearConstraint(
+                    bezopt.maxSpeedConstraints, 0, np.inf,
+                    jac=bezopt.maxSpeedConstraintsJac),
+                sop.NonlinearConstraint(
+                    bezopt.maxAngularRateConstraints, 0, np.inf,
+                    jac=bezopt.maxAngularRateConstraintsJac)]
+
+    # Evaluate everything once so that the cached matrices are built and the
+    # numba kernels are compiled before the timer is started
+    bezopt.objectiveAndGradient(xGuess)
+    for cons in ineqCons:
+        cons.fun(xGuess)
+        cons.jac(xGuess)
+
+    history = []
     startTime = time.time()
-    print('starting')
-    results = sop.minimize(
-                bezopt.objectiveFunction,
-                x0=xGuess,
-                method='SLSQP',
-                constraints=ineqCons,
-                options={'maxiter': 250,
-                         'disp': True,
-                         'iprint': 2}
-                )
+    results = solve(bezopt, xGuess, ineqCons, history=history)
     endTime = time.time()
 
     while not results.success:
-        xGuess = bezopt.generateGuess(std=1)
+        # Warm start from the last iterate instead of a new random guess. It
+        # is perturbed to move the solver away from where it stalled but the
+        # final time is kept positive and unperturbed.
+        xGuess = results.x + np.random.normal(scale=1.0,
+                                              size=results.x.shape)
+        xGuess[-1] = max(results.x[-1], 1e-3)
+        history = []
         startTime = time.time()
-        print('starting again')
-        results = sop.minimize(
-                    bezopt.objectiveFunction,
-                    x0=xGuess,
-                    method='SLSQP',
-                    constraints=ineqCons,
-                    options={'maxiter': 250,
-                             'disp': True,
-                             'iprint': 2}
-                    )
+        results = solve(bezopt, xGuess, ineqCons, maxiter=100,
+                        history=history)
         endTime = time.time()
 
     print('---')
+    print(results.message)
+    print('Objective by iteration: {}'.format(np.round(history, 4)))
     print('Computation Time: {}'.format(endTime - startTime))
     print('---')
 
@@ -132,7 +195,7 @@ if __name__ == '__main__':
     fig, ax = plt.subplots()
     curves = []
     for i in range(numVeh):
-        curves.append(bez.Bezier(cpts[i*dim:(i+1)*dim]))
+        curves.append(bez.Bezier(cpts[i]))
     for curve in curves:
         plt.plot(curve.curve[0], curve.curve[1], '-',
                  curve.cpts[0], curve.cpts[1], '.--')
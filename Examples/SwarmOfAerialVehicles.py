@@ -139,21 +139,25 @@ if __name__ == '__main__':
 
     xGuess = generate3DGuess(initPts, finalPts, bezopt.model['deg'])
 
-    ineqCons = [{'type': 'ineq', 'fun': bezopt.temporalSeparationConstraints}]
+    ineqCons = [{'type': 'ineq',
+                 'fun': bezopt.temporalSeparationConstraints,
+                 'jac': bezopt.temporalSeparationConstraintsJac}]
 
     startTime = time.time()
     results = sop.minimize(
-                bezopt.objectiveFunction,
+                bezopt.objectiveAndGradient,
                 x0=xGuess,
                 method='SLSQP',
+                jac=True,
                 constraints=ineqCons,
                 options={'maxiter': 100,
-                         'disp': True,
-                         'iprint': 2}
+                         'disp': False,
+                         'ftol': 1e-4}
                 )
     endTime = time.time()
 
     print('---')
+    print(results.message)
     print('Computation Time: {}'.format(endTime - startTime))
     print('---')
 
@@ -162,7 +166,7 @@ if __name__ == '__main__':
 
     curves = []
     for i in range(numVeh):
-        curves.append(bez.Bezier(cpts[i*dim:(i+1)*dim]))
+        curves.append(bez.Bezier(cpts[i]))
 
     ax = curves[0].plot(showCpts=False)
     for curve in curves[1:]:
@@ -10,22 +10,25 @@ Vehicle Missions" written by Calvin Kielas-Jensen and Venanzio Cichella.
 @author: ckielasjensen
 """
 
-from collections import defaultdict
+from collections import OrderedDict
+import functools
+import heapq
 
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
-from numba import njit, jit
+from numba import njit
 import numpy as np
-from scipy.special import binom
+from scipy.linalg import solve_triangular
 
 from gjk.gjk import gjk
 
+MAX_PASCAL_DEG = 64
+_FLOAT64 = np.dtype(np.float64)
+
 
 #TODO:
-#   Implement curve using Bernstein basis instead of de cast
 #   Precompute function to be called before optimizer
 #   Min dist 3D
-#   JIT ahead of time compiling
 #   Priorities:
 # 1. GJK for 3D
 # 2. Speed
@@ -42,16 +45,16 @@ class BezierParams:
     :param tf: Final time of the Bezier curve trajectory.
     :type tf: float
     """
-    splitCache = defaultdict(dict)
-    elevationMatrixCache = defaultdict(dict)
-    productMatrixCache = defaultdict(dict)
-    diffMatrixCache = defaultdict(dict)
-    bezCoefCache = dict()
+    # Least recently used Bernstein matrices keyed on (deg, tau bytes). The
+    # size is bounded since every new tf or tau would otherwise add a matrix
+    bernsteinMatrixCache = OrderedDict()
+    bernsteinMatrixCacheSize = 32
 
     def __init__(self, cpts=None, tau=None, tf=1.0):
         self._tau = tau
         self._tf = float(tf)
         self._curve = None
+        self._bernMat = None
 
 #        if tau is None:
 #            self._tau = np.linspace(0, self._tf, 1001)
@@ -61,11 +64,12 @@ class BezierParams:
             # are, don't call np.array since it causes a bottleneck in certain
             # iterative procedures.
             if (isinstance(cpts, np.ndarray) and
-                    cpts.dtype == 'float64' and
-                    cpts.ndim == 2):
+                    cpts.dtype == _FLOAT64 and
+                    cpts.ndim == 2 and
+                    cpts.flags.c_contiguous):
                 self._cpts = cpts
             else:
-                self._cpts = np.array(cpts, ndmin=2, dtype=float)
+                self._cpts = np.array(cpts, ndmin=2, dtype=float, order='C')
             self._dim = self._cpts.shape[0]
             self._deg = self._cpts.shape[1] - 1
         else:
@@ -80,12 +84,19 @@ class BezierParams:
     def cpts(self, value):
         self._curve = None
 
+        # Comparing against a dtype object rather than the string 'float64'
+        # avoids parsing the string on every call. Non contiguous arrays are
+        # copied so the matrix products and kernels always get C order.
         if (isinstance(value, np.ndarray) and
                 value.ndim == 2 and
-                value.dtype == 'float64'):
+                value.dtype == _FLOAT64 and
+                value.flags.c_contiguous):
             newCpts = value
         else:
-            newCpts = np.array(value, ndmin=2, dtype=float)
+            newCpts = np.array(value, ndmin=2, dtype=float, order='C')
+
+        if newCpts.shape[1] - 1 != self._deg:
+            self._bernMat = None
 
         self._dim = newCpts.shape[0]
         self._deg = newCpts.shape[1] - 1
@@ -113,6 +124,8 @@ class BezierParams:
 
     @tf.setter
     def tf(self, value):
+        self._curve = None
+        self._bernMat = None
         self._tf = float(value)
         self._tau = None
 
@@ -127,6 +140,7 @@ class BezierParams:
     @tau.setter
     def tau(self, val):
         self._curve = None
+        self._bernMat = None
         self._tf = val[-1]
         self._tau = val
 
@@ -207,12 +221,51 @@ class Bezier(BezierParams):
             self._tau = np.arange(0, 1.01, 0.01)
 
         if self._curve is None:
-            self._curve = np.zeros([self.dim, len(self.tau)])
-            for i, pts in enumerate(self.cpts):
-                self._curve[i] = deCasteljauCurve(pts, self.tau, self.tf)
+            # The normalized tau and the matrix lookup are only redone when
+            # tau, tf, or the degree change, not every time cpts is set
+            if self._bernMat is None:
+                tau = np.asarray(self.tau, dtype=float) / self.tf
+                key = (self.deg, tau.tobytes())
+                cache = Bezier.bernsteinMatrixCache
+                try:
+                    bernMat = cache[key]
+                    cache.move_to_end(key)
+                except KeyError:
+                    bernMat = bernsteinMatrix(self.deg, tau)
+                    bernMat.setflags(write=False)
+                    cache[key] = bernMat
+                    if len(cache) > Bezier.bernsteinMatrixCacheSize:
+                        cache.popitem(last=False)
+                self._bernMat = bernMat
+
+            self._curve = np.dot(self.cpts, self._bernMat)
 
         return self._curve
 
+    def evaluate(self, tau):
+        """Evaluates the curve at tau without changing the curve's tau
+
+        If a Bernstein matrix has already been built for these values of tau
+        (e.g. by the curve property) the curve is a single matrix product.
+        Otherwise building the matrix costs more than evaluating the curve so
+        the compiled O(n) per point bernsteinCurve kernel is used instead. This
+        avoids the O(n^2) per point cost of de Casteljau's algorithm for the
+        elevated, high degree curves.
+
+        :param tau: Values at which to evaluate the curve, on the range of
+            [0, tf].
+        :type tau: numpy.ndarray
+        :return: Curve evaluated at each value of tau, dim x len(tau)
+        :rtype: numpy.ndarray
+        """
+        tau = np.array(tau, dtype=np.float64, ndmin=1) / self.tf
+
+        bernMat = Bezier.bernsteinMatrixCache.get((self.deg, tau.tobytes()))
+        if bernMat is None:
+            return bernsteinCurve(self.cpts, tau)
+
+        return np.dot(self.cpts, bernMat)
+
     def copy(self):
         """Creates an exact, deep copy of the current Bezier object
 
@@ -323,33 +376,7 @@ class Bezier(BezierParams):
                            dim, multiplicand.dim))
             raise ValueError(msg)
 
-        a = np.array(self.cpts, ndmin=2)
-        b = np.array(multiplicand.cpts, ndmin=2)
-        m = self.deg
-        n = multiplicand.deg
-
-        c = np.empty((dim, m+n+1))
-
-        try:
-            coefMat = Bezier.productMatrixCache[m][n]
-        except KeyError:
-            coefMat = bezProductCoefficients(m, n)
-            Bezier.productMatrixCache[m][n] = coefMat
-
-        for d in range(dim):
-            c[d] = multiplyBezCurves(a[d], b[d], coefMat)
-
-#   This code uses Farouki's method for multiplication but does not simplify
-#   the problem using matrices.
-#        for d in range(dim):
-#            for k in np.arange(0, m+n+1):
-#                summation = 0
-#                for j in np.arange(max(0, k-n), min(m, k)+1):
-#                    summation += binom(m, j)  \
-#                                 * binom(n, k-j)  \
-#                                 * a[d, j]  \
-#                                 * b[d, k-j]
-#                c[d, k] = summation / binom(m+n, k)
+        c = convolveBezCurves(self.cpts, multiplicand.cpts)
 
         newCurve = self.copy()
         newCurve.cpts = c
@@ -370,24 +397,17 @@ class Bezier(BezierParams):
         :rtype: RationalBezier
         """
         if not isinstance(denominator, Bezier):
-            msg = ('The denominator must be a Bezier object, not a %s. '
+            msg = ('The denominator must be a Bezier object, not a {}. '
                    'Or the module has been reloaded.').format(
                            type(denominator))
             raise TypeError(msg)
 
-        cpts = np.empty((self.dim, self.deg+1))
-        for i in range(self.dim+1):
-            for j in range(self.deg+2):
-                if self.cpts[i, j] == 0:
-                    cpts[i, j] = 0
-                else:
-                    cpts[i, j] = self.cpts[i, j] / denominator.cpts[i, j]
-
-        weights = denominator.cpts
+        # Zero numerators stay zero even where the weight is zero
+        cpts = np.divide(self.cpts, denominator.cpts,
+                         out=np.zeros((self.dim, self.deg+1)),
+                         where=self.cpts != 0)
 
-        return RationalBezier(cpts.astype(np.float64),
-                              weights.astype(np.float64),
-                              tau=self.tau, tf=self.tf)
+        return RationalBezier(cpts, denominator.cpts, tau=self.tau, tf=self.tf)
 
     def elev(self, R=1):
         """Elevates the degree of the Bezier curve
@@ -400,17 +420,10 @@ class Bezier(BezierParams):
         :return: Elevated Bezier curve
         :rtype: Bezier
         """
-        try:
-            elevMat = Bezier.elevationMatrixCache[self.deg][R]
-        except KeyError:
-            elevMat = elevMatrix(self.deg, R)
-            Bezier.elevationMatrixCache[self.deg][R] = elevMat
-
-        elevPts = []
-        for cpts in self.cpts:
-            elevPts.append(np.dot(cpts, elevMat))
-
-        elevPts = np.vstack(elevPts)
+        if R == 0:
+            elevPts = self.cpts.copy()
+        else:
+            elevPts = elevateBezCurve(self.cpts, R)
 
         curveElev = self.copy()
         curveElev.cpts = elevPts
@@ -421,25 +434,21 @@ class Bezier(BezierParams):
         """Calculates the derivative of the Bezier curve
 
         Note that this does not affect the object. Instead it returns the
-        derivative.
+        derivative. The derivative is elevated back to the degree of the
+        original curve, with differentiation and elevation fused into a single
+        cached matrix.
 
         :return: Derivative of the Bezier curve
         :rtype: Bezier
         """
-        try:
-            Dm = Bezier.diffMatrixCache[self.deg][self.tf]
-        except KeyError:
-            Dm = diffMatrix(self.deg, self.tf)
-            Bezier.diffMatrixCache[self.deg][self.tf] = Dm
-
-        cptsDot = []
-        for i in range(self.dim):
-            cptsDot.append(np.dot(self.cpts[i, :], Dm))
-
         curveDot = self.copy()
-        curveDot.cpts = cptsDot
+        if self.deg == 0:
+            curveDot.cpts = np.zeros_like(self.cpts)
+        else:
+            curveDot.cpts = np.dot(self.cpts,
+                                   _diffElevMatrix(self.deg)) / self.tf
 
-        return curveDot.elev()
+        return curveDot
 
     def integrate(self):
         """Calculates the area under the curve in each dimension
@@ -447,11 +456,7 @@ class Bezier(BezierParams):
         :return: Area under the curve in each dimension.
         :rtype: numpy.ndarray
         """
-        areas = np.empty(self.dim)
-        for d in range(self.dim):
-            areas[d] = self.tf * sum(self.cpts[d]) / (self.deg+1)
-
-        return areas
+        return self.tf * self.cpts.sum(axis=1) / (self.deg+1)
 
     def split(self, tDiv):
         """Splits the curve into two curves at point tDiv
@@ -488,230 +493,49 @@ class Bezier(BezierParams):
     def min(self, dim=0, tol=1e-6, maxIter=1000):
         """Returns the minimum value of the Bezier curve in a single dimension
 
-        Finds the minimum value of the Bezier curve. This is done by first
-        checking the first and last control points since the first and last
-        point lie on the curve. If the first or last control point is not the
-        minimum value, the curve is split at the lowest control point. The new
-        minimum value is then defined as the lowest control point of the two
-        new curves. This continues until the difference between the new minimum
-        and old minimum values is within the desired tolerance.
+        Finds the minimum value of the Bezier curve using branch and bound, see
+        _maxCpts. The minimum is found as the negative of the maximum of the
+        negated control points. Pieces of the curve whose smallest control
+        point is above the best value found on the curve are never split.
 
         :param dim: Which dimension to return the minimum of.
         :type dim: int
-        :param tol: Tolerance of the minimum value.
+        :param tol: Relative tolerance of the minimum value.
         :type tol: float
-        :param maxIter: Maximum number of iterations to search for the minimum.
+        :param maxIter: Maximum number of splits to search for the minimum.
         :type maxIter: int
         :return: Minimum value of the Bezier curve. None if maximum iterations
             is met.
         :rtype: float or None
         """
-        minVal = min(self.cpts[dim, :])
-        tol = np.abs(tol*np.mean(self.cpts))
-
-        if self.cpts[dim, 0] == minVal:
-            return self.cpts[dim, 0]
-
-        elif self.cpts[dim, -1] == minVal:
-            return self.cpts[dim, -1]
-
-        else:
-            lastMin = np.inf
-            newCurve = self.copy()
-            for _ in range(maxIter):
-                splitPoint = (np.argmin(newCurve.cpts[dim, :])
-                              / (newCurve.deg+1.0))
-                c1, c2 = newCurve.split(splitPoint)
-
-                min1 = min(c1.cpts[dim, :])
-                min2 = min(c2.cpts[dim, :])
-
-                if min1 < min2:
-                    newCurve = c1
-                    newMin = min1
-
-                else:
-                    newCurve = c2
-                    newMin = min2
-
-                if np.abs(newMin-lastMin) < tol:
-                    return newMin
-                else:
-                    lastMin = newMin
+        negMin, converged = _maxCpts(-self.cpts[dim, :], tol, maxIter)
 
+        if not converged:
             print('Maximum number of iterations met')
             return None
 
-#    def max4(self, dim=0, tol=1e-6, maxIter=1000):
-#        """Returns the maximum value of the Bezier curve in a single dimension
-#
-#        Finds the maximum value of the Bezier curve. This is done by first
-#        checking the first and last control points since the first and last
-#        point lie on the curve. If the first or last control point is not the
-#        maximum value, the curve is split at the highest control point. The new
-#        maximum value is then defined as the highest control point of the two
-#        new curves. This continues until the difference between the new maximum
-#        and old maximum values is within the desired tolerance.
-#
-#        :param dim: Which dimension to return the maximum of.
-#        :type dim: int
-#        :param tol: Tolerance of the maximum value.
-#        :type tol: float
-#        :param maxIter: Maximum number of iterations to search for the minimum.
-#        :type maxIter: int
-#        :return: Maximum value of the Bezier curve. None if maximum iterations
-#            is met.
-#        :rtype: float or None
-#        """
-#        maxVal = max(self.cpts[dim, :])
-#
-#        if self.cpts[dim, 0] == maxVal:
-#            return self.cpts[dim, 0]
-#
-#        elif self.cpts[dim, -1] == maxVal:
-#            return self.cpts[dim, -1]
-#
-#        else:
-#            lastMax = np.inf
-#            newCurve = self.copy()
-#            for _ in range(maxIter):
-#                splitPoint = (np.argmax(newCurve.cpts[dim, :])
-#                              / (newCurve.deg+1.0))
-#                c1, c2 = newCurve.split(splitPoint)
-#
-#                max1 = max(c1.cpts[dim, :])
-#                max2 = max(c2.cpts[dim, :])
-#
-#                if max1 > max2:
-#                    newCurve = c1
-#                    newMax = max1
-#
-#                else:
-#                    newCurve = c2
-#                    newMax = max2
-#
-#                if np.abs(newMax-lastMax)/newMax < tol:
-#                    return newMax
-#                else:
-#                    lastMax = newMax
-#
-#            print('Maximum number of iterations met')
-#            return None
+        return -negMin
 
 # TODO:
 #   Change error to be absolute not normalized (look @ paper)
-    def max(self, dim=0, globMax=np.inf, tol=1e-6):  # , maxIter=1000):
+    def max(self, dim=0, tol=1e-6, maxIter=1000):
         """Returns the maximum value of the Bezier curve in a single dimension
 
-        Finds the maximum value of the Bezier curve. This is done by first
-        checking the first and last control points since the first and last
-        point lie on the curve. If the first or last control point is not the
-        maximum value, the curve is split at the highest control point. The new
-        maximum value is then defined as the highest control point of the two
-        new curves. This continues until the difference between the new maximum
-        and old maximum values is within the desired tolerance.
+        Finds the maximum value of the Bezier curve using branch and bound, see
+        _maxCpts. Pieces of the curve whose largest control point is below the
+        best value found on the curve are never split.
 
         :param dim: Which dimension to return the maximum of.
         :type dim: int
-        :param tol: Tolerance of the maximum value.
+        :param tol: Relative tolerance of the maximum value.
         :type tol: float
-        :param maxIter: Maximum number of iterations to search for the minimum.
+        :param maxIter: Maximum number of splits. If it is met, the best upper
+            bound found so far is returned.
         :type maxIter: int
-        :return: Maximum value of the Bezier curve. None if maximum iterations
-            is met.
-        :rtype: float or None
+        :return: Maximum value of the Bezier curve.
+        :rtype: float
         """
-        maxIdx = np.argmax(self.cpts[dim, :])
-        newMax = max(self.cpts[dim, :])
-
-        error = np.abs(globMax-newMax) / newMax
-
-        if error < tol:
-            return newMax
-        elif maxIdx != 0 and maxIdx != self.deg:
-            splitPoint = maxIdx / self.deg
-            c1, c2 = self.split(splitPoint)
-            c1max = c1.max(dim=dim, globMax=newMax, tol=tol)
-            c2max = c2.max(dim=dim, globMax=newMax, tol=tol)
-
-            newMax = max((c1max, c2max))
-
-        return newMax
-
-#    def max3(self, dim=0, tol=1e-3, maxIter=1000):
-#        maxIdx = np.argmax(self.cpts[dim, :])
-#        oldMax = max(self.cpts[dim, :])
-#
-#        oldCurve = self.copy()
-#
-#        if maxIdx == 0 or maxIdx == self.deg:
-#            newMax = oldMax
-#        else:
-#            for _ in range(maxIter):
-#                newCurve = oldCurve.elev(oldCurve.deg+10)
-#                newMax = max(newCurve.cpts[dim, :])
-#
-#                error = np.abs(newMax-oldMax) / newMax
-#
-#                if error < tol:
-#                    break
-#
-#                oldMax = newMax
-#                oldCurve = newCurve.copy()
-#
-#        return newMax
-#
-#    def min2(self, dim=0, tol=1e-6, maxIter=1000):
-#        """Uses scipy's fminbound to find the minimum value of the Bezier curve
-#
-#        This method is slower than min because it does not exploit the useful
-#        properties of a Bezier curve.
-#
-#        :param dim: Which dimension to return the minimum of.
-#        :type dim: int
-#        :param tol: Tolerance of the minimum value.
-#        :type tol: float
-#        :param maxIter: Maximum number of iterations to search for the minimum.
-#        :type maxIter: int
-#        :return: Minimum value of the Bezier curve. None if maximum iterations
-#            is met.
-#        :rtype: float or None
-#        """
-#        def fun(x): return bezierCurve(self.cpts[dim, :], x, tf=self._tf)
-#        _, minVal, status, _ = scipy.optimize.fminbound(fun,
-#                                                        x1=0,
-#                                                        x2=1,
-#                                                        xtol=tol,
-#                                                        maxfun=maxIter,
-#                                                        full_output=True,
-#                                                        disp=1)
-#        return minVal[0] if status == 0 else None
-#
-#    def max2(self, dim=0, tol=1e-6, maxIter=1000):
-#        """Uses scipy's fminbound to find the maximum value of the Bezier curve
-#
-#        This method is slower than max because it does not exploit the useful
-#        properties of a Bezier curve.
-#
-#        :param dim: Which dimension to return the minimum of.
-#        :type dim: int
-#        :param tol: Tolerance of the minimum value.
-#        :type tol: float
-#        :param maxIter: Maximum number of iterations to search for the minimum.
-#        :type maxIter: int
-#        :return: Maximum value of the Bezier curve. None if maximum iterations
-#            is met.
-#        :rtype: float or None
-#        """
-#        def fun(x): return -bezierCurve(self.cpts[dim, :], x, tf=self._tf)
-#        _, maxVal, status, _ = scipy.optimize.fminbound(fun,
-#                                                        x1=0,
-#                                                        x2=1,
-#                                                        xtol=tol,
-#                                                        maxfun=maxIter,
-#                                                        full_output=True,
-#                                                        disp=1)
-#        return -maxVal[0] if status == 0 else None
+        return _maxCpts(self.cpts[dim, :], tol, maxIter)[0]
 
     def minDist(self, otherCurve):
         """
@@ -731,13 +555,7 @@ class Bezier(BezierParams):
         :return: Norm squared of the Bezier curve
         :rtype: Bezier
         """
-        try:
-            prodM = Bezier.productMatrixCache[self.deg][self.deg]
-        except KeyError:
-            prodM = prodMatrix(self.deg).T
-            Bezier.productMatrixCache[self.deg][self.deg] = prodM
-
-        normCpts = _normSquare(self.cpts, 1, self.dim, prodM.T)
+        normCpts = _normSquare(self.cpts, 1, self.dim, _prodMatrix(self.deg))
 
         newCurve = self.copy()
         newCurve.cpts = normCpts
@@ -762,7 +580,8 @@ def deCasteljauCurve(cpts, tau, tf=1.0):
 
     Uses the de Casteljau algorithm to generate the Bezier curve defined by
     the provided control points. Note that the datatypes are important due to
-    the nature of the numba library.
+    the nature of the numba library. The reduction is carried out for all
+    values of tau at once in a single work array.
 
     Paper Reference: Property 5: The de Casteljau Algorithm
 
@@ -780,20 +599,19 @@ def deCasteljauCurve(cpts, tau, tf=1.0):
     """
     tau = tau/tf
     curveLen = tau.size
-    curve = np.empty(curveLen)
-    curveIdx = 0
-
-    for t in tau:
-        newCpts = cpts.copy()
-        while newCpts.size > 1:
-            cptsTemp = np.empty(newCpts.size-1)
-            for i in range(cptsTemp.size):
-                cptsTemp[i] = (1-t)*newCpts[i] + t*newCpts[i+1]
-            newCpts = cptsTemp.copy()
-        curve[curveIdx] = newCpts[0]
-        curveIdx += 1
 
-    return curve
+    # Row i holds the i-th intermediate control point for every value of tau
+    # so each step of the reduction is one pass over contiguous memory
+    work = np.empty((cpts.size, curveLen))
+    for i in range(cpts.size):
+        work[i, :] = cpts[i]
+
+    for level in range(cpts.size-1, 0, -1):
+        for i in range(level):
+            for j in range(curveLen):
+                work[i, j] = (1-tau[j])*work[i, j] + tau[j]*work[i+1, j]
+
+    return work[0].copy()
 
 
 @njit(cache=True)
@@ -819,22 +637,18 @@ def deCasteljauSplit(cpts, tDiv, tf=1.0):
     :rtype: tuple(numpy.ndarray, numpy.ndarray)
     """
     tDiv = tDiv/tf
-    cptsLeft = np.zeros(cpts.size)
-    cptsRight = np.zeros(cpts.size)
-    idx = 0
+    n = cpts.size - 1
+    cptsLeft = np.empty(cpts.size)
+    cptsRight = np.empty(cpts.size)
 
+    # The reduction overwrites a single buffer in place, level k only uses
+    # the first k+1 entries
     newCpts = cpts.copy()
-    cptsTemp = cpts.copy()
-    while newCpts.size > 1:
-        cptsLeft[idx] = cptsTemp[0]
-        cptsRight[idx] = cptsTemp[-1]
-        idx += 1
-
-        cptsTemp = np.empty(newCpts.size-1)
-        for i in range(cptsTemp.size):
-            cptsTemp[i] = (1-tDiv)*newCpts[i] + tDiv*newCpts[i+1]
-
-        newCpts = cptsTemp.copy()
+    for k in range(n, 0, -1):
+        cptsLeft[n-k] = newCpts[0]
+        cptsRight[n-k] = newCpts[k]
+        for i in range(k):
+            newCpts[i] = (1-tDiv)*newCpts[i] + tDiv*newCpts[i+1]
 
     cptsLeft[-1] = cptsRight[-1] = newCpts[0]
 
@@ -845,14 +659,8 @@ def bezierCurve(cpts, tau, tf=1.0):
     """Computes the values of a 1D Bezier curve defined by the control points.
 
     Creates a 1 dimensional Bezier curve using the designated control points
-    and values of tau.
-
-    Effectively evaluates the following expression:
-        T*M*P
-    Where
-    T is the power basis vector [1 t t^2 t^3 ... t^N]
-    M is the binomial matrix (more information found in buildBezMatrix)
-    P is a vector of Bezier weights (i.e. control points)
+    and values of tau. The curve is evaluated directly in the Bernstein basis
+    by bernsteinCurve.
 
     :param cpts: Single row matrix of N+1 control points for
         a one dimensional Bezier curve.
@@ -865,21 +673,149 @@ def bezierCurve(cpts, tau, tf=1.0):
         value of tau.
     :rtype: numpy.ndarray
     """
-    cpts = np.array(cpts)
+    cpts = np.array(cpts, dtype=np.float64, ndmin=2)
     tau = np.array(tau, dtype=np.float64, ndmin=1)/float(tf)
-    tauLen = tau.size
-    n = cpts.size-1
-    curve = np.empty(tauLen)
 
-    coeffs = buildBezMatrix(n)
-    for i, t in enumerate(tau):
-        powerBasis = np.power(t, range(n+1))
-        curve[i] = np.dot(powerBasis, np.dot(coeffs, cpts.T))
+    return bernsteinCurve(cpts, tau)[0]
+
+
+@njit(cache=True, nogil=True)
+def bernsteinCurve(cpts, tau):
+    """Evaluates a Bezier curve at each value of tau using compiled loops
+
+    Each point is found in O(n) operations by factoring the Bernstein sum,
+        sum_i binom(n, i)*p_i*t^i*(1-t)^(n-i)
+            = (1-t)^n * sum_i binom(n, i)*p_i*s^i,  s = t/(1-t)
+    and evaluating the polynomial in s with Horner's method. For t >= 0.5 the
+    roles of t and 1-t are swapped so that |s| <= 1 on the range of [0, 1].
+    The binomial coefficients are built with the multiplicative recurrence so
+    no Python objects are touched inside the loops. Each Horner step is
+    applied to every point before the next, rather than running the whole
+    recurrence one point at a time, so that the innermost loop over the points
+    is independent and vectorizes.
+
+    :param cpts: Control points of the curve, dim x (n+1)
+    :type cpts: numpy.ndarray(dtype=numpy.float64)
+    :param tau: Values at which to evaluate the curve, normalized to the range
+        of [0, 1].
+    :type tau: numpy.ndarray(dtype=numpy.float64)
+    :return: Curve evaluated at each value of tau, dim x len(tau)
+    :rtype: numpy.ndarray(dtype=numpy.float64)
+    """
+    dim, numCpts = cpts.shape
+    n = numCpts - 1
+
+    binoms = np.empty(numCpts)
+    binoms[0] = 1.0
+    for i in range(n):
+        binoms[i+1] = binoms[i]*(n-i)/(i+1)
+
+    # Per point Horner variable and scale, flipped where t >= 0.5
+    numPts = tau.size
+    s = np.empty(numPts)
+    scale = np.empty(numPts)
+    flip = np.empty(numPts, dtype=np.bool_)
+    for j in range(numPts):
+        t = tau[j]
+        flip[j] = t >= 0.5
+        if flip[j]:
+            s[j] = (1-t)/t
+            scale[j] = t**n
+        else:
+            s[j] = t/(1-t)
+            scale[j] = (1-t)**n
+
+    # Horner steps run over all points at once so the inner loop has no
+    # dependency chain and can be vectorized
+    curve = np.empty((dim, numPts))
+    for d in range(dim):
+        lo = binoms[n]*cpts[d, n]
+        hi = binoms[0]*cpts[d, 0]
+        for j in range(numPts):
+            curve[d, j] = hi if flip[j] else lo
+        for k in range(1, numCpts):
+            lo = binoms[n-k]*cpts[d, n-k]
+            hi = binoms[k]*cpts[d, k]
+            for j in range(numPts):
+                curve[d, j] = curve[d, j]*s[j] + (hi if flip[j] else lo)
+        for j in range(numPts):
+            curve[d, j] *= scale[j]
 
     return curve
 
 
-@jit(cache=True)
+def bernsteinMatrix(n, tau):
+    """Builds a matrix of the Bernstein basis polynomials evaluated at tau
+
+    Evaluating a Bezier curve at fixed values of tau is linear in the control
+    points. The curve is therefore found with a single matrix product,
+        cpts*B
+    where B[i, j] = binom(n, i) * tau_j^i * (1-tau_j)^(n-i). This replaces a
+    de Casteljau evaluation per point when the same values of tau are used
+    repeatedly.
+
+    Paper Reference: Property 1: Definition of a Bezier curve
+
+    :param n: Degree of the Bezier curve
+    :type n: int
+    :param tau: Values at which to evaluate the Bezier curve, normalized to
+        the range of [0, 1].
+    :type tau: numpy.ndarray
+    :return: Bernstein matrix of size (n+1) x len(tau)
+    :rtype: numpy.ndarray
+    """
+    tau = np.asarray(tau, dtype=float)
+    i = np.arange(n+1)[:, np.newaxis]
+    binoms = pascalTriangle(n)[n, :n+1, np.newaxis]
+
+    return binoms * tau**i * (1-tau)**(n-i)
+
+
+@njit(cache=True)
+def _buildPascal(n):
+    """Builds Pascal's triangle using the additive recurrence
+
+    :param n: Largest row of the triangle
+    :type n: int
+    :return: Binomial coefficients where element [i, k] is i choose k, zero
+        for k > i. Size (n+1) x (n+1)
+    :rtype: numpy.ndarray
+    """
+    table = np.zeros((n+1, n+1))
+    for i in range(n+1):
+        table[i, 0] = 1.0
+        for k in range(1, i+1):
+            table[i, k] = table[i-1, k-1] + table[i-1, k]
+
+    return table
+
+
+PASCAL = _buildPascal(MAX_PASCAL_DEG)
+PASCAL.setflags(write=False)
+
+
+def pascalTriangle(n):
+    """Returns a table of binomial coefficients with at least n+1 rows
+
+    The binomial coefficients needed by the Python level functions are looked
+    up in a table rather than calling scipy.special.binom for each element.
+    Degrees up to MAX_PASCAL_DEG use the table built at import, larger ones
+    build a new table. The compiled matrix builders call _buildPascal
+    directly. Note that negative indices wrap around so the callers must keep
+    k within [0, n].
+
+    :param n: Largest value of n that will be indexed
+    :type n: int
+    :return: Table where element [n, k] is n choose k
+    :rtype: numpy.ndarray
+    """
+    if n <= MAX_PASCAL_DEG:
+        return PASCAL
+
+    return _buildPascal(n)
+
+
+@njit(cache=True)
 def buildBezMatrix(n):
     """Builds a matrix of coefficients of the power basis to a Bernstein
     polynomial.
@@ -902,16 +838,16 @@ def buildBezMatrix(n):
     :return: Power basis matrix of coefficients for a Bezier curve
     :rtype: numpy.ndarray
     """
+    pascal = _buildPascal(n)
     bezMatrix = np.zeros((n+1, n+1))
 
-    for k in np.arange(0, n+1):
-        for i in np.arange(k, n+1):
-            bezMatrix[i, k] = (-1)**(i-k) * binom(n, i) * binom(i, k)
+    for k in range(n+1):
+        for i in range(k, n+1):
+            bezMatrix[i, k] = (-1)**(i-k) * pascal[n, i] * pascal[i, k]
 
     return bezMatrix
 
 
-@njit(cache=True)
 def diffMatrix(n, tf=1.0):
     """Generates the differentiation matrix to find the derivative
 
@@ -929,15 +865,15 @@ def diffMatrix(n, tf=1.0):
     :rtype: numpy.ndarray
     """
     val = n/tf
+    idx = np.arange(n)
     Dm = np.zeros((n+1, n))
-    for i in range(n):
-        Dm[i, i] = -val
-        Dm[i+1, i] = val
+    Dm[idx, idx] = -val
+    Dm[idx+1, idx] = val
 
     return Dm
 
 
-@jit(cache=True)
+@njit(cache=True)
 def elevMatrix(N, R=1):
     """Creates an elevation matrix for a Bezier curve.
 
@@ -952,16 +888,50 @@ def elevMatrix(N, R=1):
     :return: Elevation matrix to raise a Bezier curve of degree N by R degrees
     :rtype: numpy.ndarray
     """
+    pascal = _buildPascal(N+R)
     T = np.zeros((N+1, N+R+1))
     for i in range(N+R+1):
-        den = binom(N+R, i)
-        for j in range(N+1):
-            T[j, i] = binom(N, j) * binom(R, i-j) / den
+        den = pascal[N+R, i]
+        for j in range(max(0, i-R), min(N, i)+1):
+            T[j, i] = pascal[N, j] * pascal[R, i-j] / den
 
     return T
 
 
-@jit(cache=True)
+@njit(cache=True)
+def elevateBezCurve(cpts, R=1):
+    """Elevates the degree of each row of control points by R
+
+    Rather than multiplying by the dense elevation matrix, R single degree
+    elevations are applied. Each one only mixes neighboring control points,
+        P'_i = i/(n+1)*P_(i-1) + (1 - i/(n+1))*P_i
+    so the cost is O(R*n) rather than O(n*(n+R)) and no matrix is built.
+
+    :param cpts: Control points of the curve, dim x (n+1)
+    :type cpts: numpy.ndarray(dtype=numpy.float64)
+    :param R: Number of degrees to elevate the curve
+    :type R: int
+    :return: Control points of the elevated curve, dim x (n+R+1)
+    :rtype: numpy.ndarray(dtype=numpy.float64)
+    """
+    dim, numCpts = cpts.shape
+    elevPts = np.empty((dim, numCpts+R))
+    elevPts[:, :numCpts] = cpts
+
+    for n in range(numCpts-1, numCpts-1+R):
+        for d in range(dim):
+            prev = elevPts[d, 0]
+            for i in range(1, n+1):
+                cur = elevPts[d, i]
+                alpha = i/(n+1)
+                elevPts[d, i] = alpha*prev + (1-alpha)*cur
+                prev = cur
+            elevPts[d, n+1] = prev
+
+    return elevPts
+
+
+@njit(cache=True)
 def prodMatrix(N):
     """Produces a product matrix for obtaining the norm of a Bezier curve
 
@@ -979,13 +949,13 @@ def prodMatrix(N):
     :return: Product matrix
     :rtype: numpy.ndarray
     """
+    pascal = _buildPascal(2*N)
     T = np.zeros((2*N+1, (N+1)**2))
 
-    for j in np.arange(2*N+1):
-        den = binom(2*N, j)
-        for i in np.arange(max(0, j-N), min(N, j)+1):
-            if N >= i and N >= j-i and 2*N >= j and j-i >= 0:
-                T[j, N*i+j] = binom(N, i)*binom(N, j-i) / den
+    for j in range(2*N+1):
+        den = pascal[2*N, j]
+        for i in range(max(0, j-N), min(N, j)+1):
+            T[j, N*i+j] = pascal[N, i]*pascal[N, j-i] / den
 
     return T
 
@@ -993,7 +963,7 @@ def prodMatrix(N):
 # TODO:
 #    Change this function name to prodM.
 #    Clean up and slightly change _normSquare to accommodate this change
-@jit(cache=True)
+@njit(cache=True)
 def bezProductCoefficients(m, n=None):
     """Produces a product matrix for obtaining the product of two Bezier curves
 
@@ -1009,34 +979,33 @@ def bezProductCoefficients(m, n=None):
     :rtype: numpy.ndarray
     """
 
-    if n is None:
-        n = m
+    # A new name keeps n from being typed as optional by numba
+    deg2 = m if n is None else n
 
-    coefMat = np.zeros(((m+1)*(n+1), m+n+1))
+    pascal = _buildPascal(m+deg2)
+    coefMat = np.zeros(((m+1)*(deg2+1), m+deg2+1))
 
-    for k in range(m+n+1):
-        den = binom(m+n, k)
-        for j in range(max(0, k-n), min(m, k)+1):
-            coefMat[m*j+k, k] = binom(m, j)*binom(n, k-j)/den
+    for k in range(m+deg2+1):
+        den = pascal[m+deg2, k]
+        for j in range(max(0, k-deg2), min(m, k)+1):
+            # Row of the flattened outer product, (deg2+1)*j + (k-j)
+            coefMat[deg2*j+k, k] = pascal[m, j]*pascal[deg2, k-j]/den
 
     return coefMat
 
 
-@jit(cache=True)
 def multiplyBezCurves(multiplier, multiplicand, coefMat=None):
     """Multiplies two Bezier curves together
 
     The product of two Bezier curves can be computed directly from their
-    control points. This function specifically uses matrix multiplication to
-    increase the speed of the multiplication.
+    control points. Without a coefficient matrix this is the binomial scaled
+    convolution in convolveBezCurves, which only touches the (m+1)*(n+1)
+    nonzero terms. If a matrix of product coefficients from
+    bezProductCoefficients is passed in, the flattened outer product of the
+    control points is multiplied by it instead.
 
     Note that this function is made for 1D control points.
 
-    One can pass in a matrix of product coefficients to compute the product
-    about 10x faster. It is recommended that the coefficient matrix is
-    precomputed and saved in memory when performing multiplication many times.
-    The function bezProductCoefficients will produce this matrix.
-
     :param multiplier: Control points of the multiplier curve. Single dimension
     :type multiplier: numpy.ndarray
     :param multiplicand: Control points of the multiplicand curve.
@@ -1046,21 +1015,99 @@ def multiplyBezCurves(multiplier, multiplicand, coefMat=None):
     :return: Product of two Bezier curves
     :rtype: numpy.ndarray
     """
-    multiplier = np.atleast_2d(multiplier)
-    multiplicand = np.atleast_2d(multiplicand)
+    if coefMat is None:
+        return convolveBezCurves(multiplier, multiplicand)
+
+    augMat = np.multiply.outer(np.ravel(multiplier), np.ravel(multiplicand))
+
+    return np.dot(augMat.reshape((1, -1)), coefMat)
+
+
+def convolveBezCurves(multiplier, multiplicand):
+    """Multiplies the rows of two sets of control points using convolution
+
+    Scaling the control points of a degree m curve by binom(m, i) turns the
+    product into a discrete convolution. The product's control points are
+    then found by dividing by binom(m+n, k). Each row of the control points
+    is treated as a 1D Bezier curve and all of the rows are convolved in one
+    compiled call.
+
+    Source: Section 5.1 of "The Bernstein Polynomial Basis: A Centennial
+    Retrospective" by Farouki.
+
+    :param multiplier: Control points of the multiplier, dim x (m+1)
+    :type multiplier: numpy.ndarray
+    :param multiplicand: Control points of the multiplicand, dim x (n+1)
+    :type multiplicand: numpy.ndarray
+    :return: Control points of the product, dim x (m+n+1)
+    :rtype: numpy.ndarray
+    """
+    multiplier = np.atleast_2d(np.asarray(multiplier, dtype=float))
+    multiplicand = np.atleast_2d(np.asarray(multiplicand, dtype=float))
     m = multiplier.shape[1] - 1
     n = multiplicand.shape[1] - 1
 
-    augMat = np.dot(multiplier.T, multiplicand)
-    newMat = augMat.reshape((1, -1))
+    pascal = pascalTriangle(m+n)
+    a = multiplier*pascal[m, :m+1]
+    b = multiplicand*pascal[n, :n+1]
+    c = _convolveRows(a, b)
 
-    if coefMat is None:
-        coefMat = bezProductCoefficients(m, n)
+    return c / pascal[m+n, :m+n+1]
+
+
+@njit(cache=True)
+def _convolveRows(a, b):
+    """Convolves each row of a with the same row of b in a single call
+
+    :param a: First set of rows, dim x (m+1)
+    :type a: numpy.ndarray(dtype=numpy.float64)
+    :param b: Second set of rows, dim x (n+1)
+    :type b: numpy.ndarray(dtype=numpy.float64)
+    :return: Full convolution of each pair of rows, dim x (m+n+1)
+    :rtype: numpy.ndarray(dtype=numpy.float64)
+    """
+    dim, numA = a.shape
+    numB = b.shape[1]
+    c = np.zeros((dim, numA+numB-1))
+    for d in range(dim):
+        for i in range(numA):
+            for j in range(numB):
+                c[d, i+j] += a[d, i]*b[d, j]
 
-    return np.dot(newMat, coefMat)
+    return c
+
+
+@functools.lru_cache(maxsize=None)
+def _bezMatrix(deg):
+    """Memoized, read-only buildBezMatrix(deg)
+    """
+    coefMat = buildBezMatrix(deg)
+    coefMat.setflags(write=False)
+    return coefMat
+
+
+@functools.lru_cache(maxsize=None)
+def _diffElevMatrix(deg):
+    """Memoized, read-only matrix that differentiates a curve of degree deg
+    with tf = 1 and elevates the result back to degree deg
+
+    The derivative scales with 1/tf, which is applied to the product so that
+    the cache is not keyed on the final time.
+    """
+    diffElevMat = np.dot(diffMatrix(deg, 1.0), elevMatrix(deg-1, 1))
+    diffElevMat.setflags(write=False)
+    return diffElevMat
+
+
+@functools.lru_cache(maxsize=None)
+def _prodMatrix(deg):
+    """Memoized, read-only prodMatrix(deg)
+    """
+    prodM = np.ascontiguousarray(prodMatrix(deg))
+    prodM.setflags(write=False)
+    return prodM
 
 
-@jit(cache=True)
 def splitCurveMat(deg, z, coefMat=None):
     """Creates matrices Q and Qp that are used to compute control points for a
         split curve.
@@ -1078,72 +1125,159 @@ def splitCurveMat(deg, z, coefMat=None):
         is the Q matrix for computing after the point z.
     :rtype: tuple(numpy.ndarray, numpy.ndarray)
     """
-    powMat = np.diag(np.power(z, range(deg+1)))
-
     if coefMat is None:
-        coefMat = buildBezMatrix(deg)
+        coefMat = _bezMatrix(deg)
 
-    # Q = M^-1 * Z * M
-    Q = np.linalg.inv(coefMat).dot(powMat).dot(coefMat)
+    # Q = M^-1 * Z * M where Z is diagonal and M is lower triangular, so Z*M
+    # is a row scaling and M^-1 is applied with a triangular solve
+    zM = np.power(float(z), np.arange(deg+1))[:, np.newaxis] * coefMat
+    Q = solve_triangular(coefMat, zM, lower=True)
 
-    # Qp is just Q but rolled and flipped
-    Qp = np.empty((deg+1, deg+1))
-    for i, row in enumerate(Q):
-        Qp[deg-i, :] = np.roll(row, deg-i)
+    # Qp is just Q but rolled and flipped, row r of Qp is row deg-r of Q
+    # rolled right by r, gathered with a single fancy index
+    idx = np.arange(deg+1)
+    Qp = Q[deg - idx[:, np.newaxis], (idx - idx[:, np.newaxis]) % (deg+1)]
 
     return Q, Qp
 
 
-def _minDist(c1, c2, cnt=0, alpha=np.inf, eps=1e-3):
+def _maxCpts(cpts, tol=1e-6, maxIter=1000):
+    """Maximum of a 1D Bezier curve by branch and bound over subdivisions
+
+    The largest control point of a piece of the curve bounds its maximum from
+    above (convex hull property) and the first and last control points lie on
+    the curve, bounding the maximum of the whole curve from below. The piece
+    with the highest upper bound is repeatedly split at its highest control
+    point until that bound is within the tolerance of the lower bound.
+
+    :param cpts: Control points of the 1D curve
+    :type cpts: numpy.ndarray
+    :param tol: Relative tolerance of the maximum value.
+    :type tol: float
+    :param maxIter: Maximum number of splits
+    :type maxIter: int
+    :return: Upper bound on the maximum and whether it converged within tol
+    :rtype: tuple(float, bool)
+    """
+    lower = max(cpts[0], cpts[-1])
+
+    # Entries are (-upper bound, unique id, control points), the id breaks
+    # ties so the arrays are never compared
+    heap = [(-cpts.max(), 0, cpts)]
+    for count in range(1, maxIter+1):
+        negUpper, _, cpts = heapq.heappop(heap)
+        upper = -negUpper
+
+        if upper - lower <= tol*np.abs(upper):
+            return upper, True
+
+        maxIdx = np.argmax(cpts)
+        left, right = deCasteljauSplit(cpts, maxIdx/(cpts.size-1))
+        for side, piece in enumerate((left, right)):
+            lower = max(lower, piece[0], piece[-1])
+            heapq.heappush(heap, (-piece.max(), 2*count+side, piece))
+
+    return -heap[0][0], False
+
+
+def _minDist(c1, c2, maxDepth=10, eps=1e-3):
     """
     Source: Computation of the minimum distance between two Bezier
     curves/surfaces
+
+    Best first branch and bound over pairs of pieces of the two curves. The
+    distance between the end points of a pair bounds the minimum distance
+    from above and the GJK distance between the convex hulls of their control
+    points bounds it from below. The pair with the lowest lower bound is split
+    in half next and the search stops once no pair can improve the best upper
+    bound, alpha, by more than eps. Pairs are not split past maxDepth, in
+    which case alpha is still an upper bound on the minimum distance.
     """
-    x1 = c1.cpts[0, :]
-    y1 = c1.cpts[1, :]
-    x2 = c2.cpts[0, :]
-    y2 = c2.cpts[1, :]
-    poly1 = np.array(tuple(zip(x1, y1, [0]*x1.size)))
-    poly2 = np.array(tuple(zip(x2, y2, [0]*x1.size)))
-
-    cnt += 1
-    if cnt > 10:
-        return -1
-
-    ub = _upperbound(c1.cpts, c2.cpts)
-    lb = gjk(poly1, poly2, maxIter=10)
-
-    if ub <= alpha:
-        alpha = ub
-
-    if lb >= alpha*(1-eps):
-        return alpha
-    else:
-        c3, c4 = c1.split(0.5)
-        c5, c6 = c2.split(0.5)
-        alpha = min(alpha, _minDist(c3, c5, cnt=cnt, alpha=alpha))
-        alpha = min(alpha, _minDist(c3, c6, cnt=cnt, alpha=alpha))
-        alpha = min(alpha, _minDist(c4, c5, cnt=cnt, alpha=alpha))
-        alpha = min(alpha, _minDist(c4, c6, cnt=cnt, alpha=alpha))
+    alpha = _upperbound(c1.cpts, c2.cpts)
+    lb = gjk(_hullPoints(c1.cpts), _hullPoints(c2.cpts), maxIter=10)
+
+    # Entries are (lower bound, unique id, depth, cpts1, cpts2), the id breaks
+    # ties so the arrays are never compared
+    heap = [(lb, 0, 0, c1.cpts, c2.cpts)]
+    count = 0
+    while heap:
+        lb, _, depth, cpts1, cpts2 = heapq.heappop(heap)
+        if lb >= alpha*(1-eps):
+            break
+        if depth >= maxDepth:
+            continue
+
+        halves1 = _splitHalves(cpts1)
+        halves2 = _splitHalves(cpts2)
+        alpha = min(alpha, _splitUpperbound(*halves1, *halves2))
+        for piece1 in halves1:
+            for piece2 in halves2:
+                lb = gjk(_hullPoints(piece1), _hullPoints(piece2), maxIter=10)
+                if lb < alpha*(1-eps):
+                    count += 1
+                    heapq.heappush(heap, (lb, count, depth+1, piece1, piece2))
 
     return alpha
 
 
+def _splitHalves(cpts):
+    """Splits each row of the control points in half with de Casteljau
+    """
+    halves = [deCasteljauSplit(row, 0.5) for row in cpts]
+    return (np.array([left for left, _ in halves]),
+            np.array([right for _, right in halves]))
+
+
+def _hullPoints(cpts):
+    """Control points of a 2D curve as the N x 3 polygon expected by gjk
+    """
+    poly = np.zeros((cpts.shape[1], 3))
+    poly[:, :2] = cpts[:2].T
+    return poly
+
+
 @njit(cache=True)
 def _upperbound(c1, c2):
-    distances = np.empty(4)
+    """Smallest distance between the end points of two 2D curves
+
+    The squared distances are compared so only one square root is taken.
+    """
+    last1 = c1.shape[1] - 1
+    last2 = c2.shape[1] - 1
 
-    distances[0] = _norm(c1[:, 0] - c2[:, 0])
-    distances[1] = _norm(c1[:, 0] - c2[:, -1])
-    distances[2] = _norm(c1[:, -1] - c2[:, 0])
-    distances[3] = _norm(c1[:, -1] - c2[:, -1])
+    minSqr = np.inf
+    for i in (0, last1):
+        for j in (0, last2):
+            dx = c1[0, i] - c2[0, j]
+            dy = c1[1, i] - c2[1, j]
+            minSqr = min(minSqr, dx*dx + dy*dy)
 
-    return distances.min()
+    return np.sqrt(minSqr)
 
 
 @njit(cache=True)
-def _norm(x):
-    return np.sqrt(x[0]**2 + x[1]**2)
+def _splitUpperbound(left1, right1, left2, right2):
+    """Smallest upper bound over the four pairs of halves of two 2D curves
+
+    The end points of the halves of a curve are its first point, its split
+    point and its last point, so the bounds of all four pairs are found from
+    the 3 x 3 distances between these points in a single call.
+    """
+    last1 = right1.shape[1] - 1
+    last2 = right2.shape[1] - 1
+    x1 = (left1[0, 0], right1[0, 0], right1[0, last1])
+    y1 = (left1[1, 0], right1[1, 0], right1[1, last1])
+    x2 = (left2[0, 0], right2[0, 0], right2[0, last2])
+    y2 = (left2[1, 0], right2[1, 0], right2[1, last2])
+
+    minSqr = np.inf
+    for i in range(3):
+        for j in range(3):
+            dx = x1[i] - x2[j]
+            dy = y1[i] - y2[j]
+            minSqr = min(minSqr, dx*dx + dy*dy)
+
+    return np.sqrt(minSqr)
 
 
 # TODO
@@ -1202,26 +1336,17 @@ def _normSquare(x, Nveh, Ndim, prodM):
     OUTPUT: control points of ||x_i||^2 ... Nveh by N matrix
 
     Code ported over from Venanzio Cichella's MATLAB norm_square function.
-    NOTE: This only works on 1D or 2D matricies. It will fail for 3 or more.
     """
-#    x = np.array(x)
-#    if x.ndim == 1:
-#        x = x[None]
-
-    m, N = x.shape
-
-    xsquare = np.zeros((m, prodM.shape[0]))
-
-    for i in range(m):
-#        xaug = np.dot(x[i, None].T, x[i, None])
-        xaug = np.dot(x.T, x)
-        xnew = xaug.reshape((N**2, 1))
-        xsquare[i, :] = np.dot(prodM, xnew).T[0]
-
-    S = np.zeros((Nveh, Nveh*Ndim))
+    N = x.shape[1]
 
+    # The dimensions of a vehicle share the product matrix so their outer
+    # products are summed first, leaving one matrix product for all vehicles
+    xaug = np.zeros((Nveh, N*N))
     for i in range(Nveh):
         for j in range(Ndim):
-            S[i, Ndim*i+j] = 1
+            row = x[Ndim*i+j]
+            for k in range(N):
+                for l in range(N):
+                    xaug[i, N*k+l] += row[k]*row[l]
 
-    return np.dot(S, xsquare)
+    return np.dot(xaug, prodM.T)
@@ -6,9 +6,11 @@ Created on Tue Mar 19 06:16:46 2019
 @author: ckielasjensen
 """
 
+import functools
+
 import matplotlib.pyplot as plt
 import numba
-from numba import njit, jit
+from numba import njit
 import numpy as np
 
 import bezier as bez
@@ -40,11 +42,10 @@ class BezOptimization:
         self.pointObstacles = pointObstacles
         self.shapeObstacles = shapeObstacles
 
-        self._numCols = degree+1
-        if initPoints is not None:
-            self._numCols -= 2
-        if initSpeeds is not None:
-            self._numCols -= 2
+        self._yBase = None
+        self._dydtf = None
+        self._freeIdx = None
+        self._timeOpt = None
 
         self.model = {'numVeh': numVeh,
                       'dim': dimension,
@@ -80,25 +81,70 @@ class BezOptimization:
                    ).format(minGoal, objectivesDict.keys())
             raise ValueError(err)
 
+    @property
+    def objectiveGradient(self):
+        minGoal = self.model['minGoal'].lower()
+
+        gradientsDict = {'euclidean': self.euclideanObjectiveGrad,
+                         'timeopt': lambda x: np.eye(1, x.size, x.size-1)[0],
+                         'accel': self.accelObjectiveGrad,
+                         'jerk': self.jerkObjectiveGrad,
+                         }
+
+        try:
+            return gradientsDict[minGoal]
+        except KeyError:
+            err = ('The provided minimize goal, {}, is not a valid goal. '
+                   'The available minimize goals are:\n{}'
+                   ).format(minGoal, gradientsDict.keys())
+            raise ValueError(err)
+
+    @property
+    def objectiveAndGradient(self):
+        """Objective function that also returns its gradient
+
+        The returned function gives the tuple (objective, gradient) so that
+        the intermediate values shared by both are only computed once. Pass
+        it to scipy.optimize.minimize with jac=True.
+        """
+        minGoal = self.model['minGoal'].lower()
+
+        objectivesDict = {'euclidean': self.euclideanObjectiveAndGrad,
+                          'timeopt': lambda x: (x[-1], np.eye(1, x.size,
+                                                              x.size-1)[0]),
+                          'accel': self.accelObjectiveAndGrad,
+                          'jerk': self.jerkObjectiveAndGrad,
+                          }
+
+        try:
+            return objectivesDict[minGoal]
+        except KeyError:
+            err = ('The provided minimize goal, {}, is not a valid goal. '
+                   'The available minimize goals are:\n{}'
+                   ).format(minGoal, objectivesDict.keys())
+            raise ValueError(err)
+
     @property
     def temporalSeparationConstraints(self):
 
         if self.pointObstacles is not None:
-            numObs = self.model['numVeh'] + len(self.pointObstacles)
-            obstacleList = []
-            for obstacle in self.pointObstacles:
-                for d in range(self.model['dim']):
-                    obstacleList.append([obstacle[d]]*(self.model['deg']+1))
+            obstacles = np.repeat(np.array(self.pointObstacles, ndmin=2,
+                                           dtype=float)[:, :, np.newaxis],
+                                  self.model['deg']+1, axis=2)
+
+            y = self._cptsBuffer(obstacles)
 
             def wrapper(x):
-                y = np.vstack((self.reshapeVector(x), obstacleList))
+                self.reshapeVector(x, out=y[:self.model['numVeh']])
                 return _temporalSeparationConstraints(y,
-                                                      numObs,
+                                                      self.model['numVeh'],
                                                       self.model['dim'],
                                                       self.model['maxSep'])
         else:
+            y = self._cptsBuffer()
+
             def wrapper(x):
-                y = self.reshapeVector(x)
+                self.reshapeVector(x, out=y)
                 return _temporalSeparationConstraints(y,
                                                       self.model['numVeh'],
                                                       self.model['dim'],
@@ -106,6 +152,38 @@ class BezOptimization:
 
         return wrapper
 
+    @property
+    def temporalSeparationConstraintsJac(self):
+        """Analytic Jacobian of the temporal separation constraints
+
+        The point obstacles are appended to the reshaped vector as stationary
+        vehicles so their rows are simply dropped by the chain rule.
+        """
+        if self.pointObstacles is not None:
+            obstacles = np.repeat(np.array(self.pointObstacles, ndmin=2,
+                                           dtype=float)[:, :, np.newaxis],
+                                  self.model['deg']+1, axis=2)
+
+            y = self._cptsBuffer(obstacles)
+
+            def wrapper(x):
+                self.reshapeVector(x, out=y[:self.model['numVeh']])
+                jacY = _temporalSeparationConstraintsJac(y,
+                                                         self.model['numVeh'],
+                                                         self.model['dim'])
+                return self._chainRule(x, jacY)
+        else:
+            y = self._cptsBuffer()
+
+            def wrapper(x):
+                self.reshapeVector(x, out=y)
+                jacY = _temporalSeparationConstraintsJac(y,
+                                                         self.model['numVeh'],
+                                                         self.model['dim'])
+                return self._chainRule(x, jacY)
+
+        return wrapper
+
     def spatialSeparationConstraints(self, x):
         """
         """
@@ -120,7 +198,7 @@ class BezOptimization:
         y = self.reshapeVector(x)
 
         for i in range(numVeh):
-            vehList.append(bez.Bezier(y[i*dim:(i+1)*dim, :]))
+            vehList.append(bez.Bezier(y[i]))
 
         for obstacle in self.shapeObstacles:
             vehList.append(obstacle)
@@ -136,12 +214,14 @@ class BezOptimization:
     def minSpeedConstraints(self):
         """
         """
+        y = self._cptsBuffer()
+
         def wrapper(x):
             if self.model['minGoal'].lower() == 'timeopt':
                 tf = x[-1]
             else:
                 tf = self.model['tf']
-            y = self.reshapeVector(x)
+            self.reshapeVector(x, out=y)
             return _minSpeedConstraints(y,
                                         self.model['numVeh'],
                                         self.model['dim'],
@@ -150,16 +230,37 @@ class BezOptimization:
                                         )
         return wrapper
 
+    @property
+    def minSpeedConstraintsJac(self):
+        """Analytic Jacobian of the minimum speed constraints
+        """
+        y = self._cptsBuffer()
+
+        def wrapper(x):
+            if self.model['minGoal'].lower() == 'timeopt':
+                tf = x[-1]
+            else:
+                tf = self.model['tf']
+            self.reshapeVector(x, out=y)
+            jacY, dgdtf = _speedSqrJac(y,
+                                       self.model['numVeh'],
+                                       self.model['dim'],
+                                       tf)
+            return self._chainRule(x, jacY, dgdtf)
+        return wrapper
+
     @property
     def maxSpeedConstraints(self):
         """
         """
+        y = self._cptsBuffer()
+
         def wrapper(x):
             if self.model['minGoal'].lower() == 'timeopt':
                 tf = x[-1]
             else:
                 tf = self.model['tf']
-            y = self.reshapeVector(x)
+            self.reshapeVector(x, out=y)
             return _maxSpeedConstraints(y,
                                         self.model['numVeh'],
                                         self.model['dim'],
@@ -168,16 +269,37 @@ class BezOptimization:
                                         )
         return wrapper
 
+    @property
+    def maxSpeedConstraintsJac(self):
+        """Analytic Jacobian of the maximum speed constraints
+        """
+        y = self._cptsBuffer()
+
+        def wrapper(x):
+            if self.model['minGoal'].lower() == 'timeopt':
+                tf = x[-1]
+            else:
+                tf = self.model['tf']
+            self.reshapeVector(x, out=y)
+            jacY, dgdtf = _speedSqrJac(y,
+                                       self.model['numVeh'],
+                                       self.model['dim'],
+                                       tf)
+            return -self._chainRule(x, jacY, dgdtf)
+        return wrapper
+
     @property
     def maxAngularRateConstraints(self):
         """
         """
+        y = self._cptsBuffer()
+
         def wrapper(x):
             if self.model['minGoal'].lower() == 'timeopt':
                 tf = x[-1]
             else:
                 tf = self.model['tf']
-            y = self.reshapeVector(x)
+            self.reshapeVector(x, out=y)
             return _maxAngularRateConstraints(y,
                                               self.model['numVeh'],
                                               self.model['dim'],
@@ -186,6 +308,25 @@ class BezOptimization:
                                               )
         return wrapper
 
+    @property
+    def maxAngularRateConstraintsJac(self):
+        """Analytic Jacobian of the maximum angular rate constraints
+        """
+        y = self._cptsBuffer()
+
+        def wrapper(x):
+            if self.model['minGoal'].lower() == 'timeopt':
+                tf = x[-1]
+            else:
+                tf = self.model['tf']
+            self.reshapeVector(x, out=y)
+            jacY, dgdtf = _angularRateSqrJac(y,
+                                             self.model['numVeh'],
+                                             self.model['dim'],
+                                             tf)
+            return -self._chainRule(x, jacY, dgdtf)
+        return wrapper
+
     def generateGuess(self, std=0, seed=None):
         """
         """
@@ -239,13 +380,80 @@ class BezOptimization:
 
         return np.concatenate(xGuess)
 
-    def reshapeVector(self, x):
+    def reshapeVector(self, x, out=None):
+        """Reshapes the optimization vector into the vehicles' control points
+
+        The control points of every vehicle are stored in a single C
+        contiguous array so that the constraint kernels can operate on all of
+        the vehicles at once and the control points of vehicle i are simply
+        y[i].
+
+        :param x: Optimization vector
+        :type x: numpy.ndarray
+        :param out: If provided, the control points are written into this C
+            contiguous array instead of a new one, see _cptsBuffer.
+        :type out: numpy.ndarray or None
+        :return: Control points of the vehicles, numVeh x dim x (deg+1)
+        :rtype: numpy.ndarray
         """
+        if self._yBase is None:
+            self._processModel()
+
+        # If we are optimizing time, grab the last element which is tf
+        if self._timeOpt:
+            tf = x[-1]
+            x = x[:-1]
+        else:
+            tf = self.model['tf']
+
+        if out is None:
+            y = self._yBase + tf*self._dydtf
+        else:
+            y = np.multiply(self._dydtf, tf, out=out)
+            y += self._yBase
+        np.put(y, self._freeIdx, x)
+
+        return y
+
+    def _cptsBuffer(self, obstacles=None):
+        """Preallocates an array for the reshaped vector
+
+        The constraint wrappers reshape into their own buffer on every call
+        rather than allocating new arrays. Any obstacles are stored after the
+        vehicles once so they do not need to be concatenated on each call.
+        Since the buffers are reused, the wrappers are not thread safe.
+
+        :param obstacles: Control points of stationary obstacles,
+            numObs x dim x (deg+1)
+        :type obstacles: numpy.ndarray or None
+        :return: Buffer of size (numVeh+numObs) x dim x (deg+1)
+        :rtype: numpy.ndarray
+        """
+        numVeh = self.model['numVeh']
+        shape = (numVeh, self.model['dim'], self.model['deg']+1)
+
+        if obstacles is None:
+            return np.empty(shape)
+
+        buffer = np.empty((numVeh+obstacles.shape[0],) + shape[1:])
+        buffer[numVeh:] = obstacles
+
+        return buffer
+
+    def _processModel(self):
+        """Precomputes the parts of the reshaped vector that do not depend on x
+
+        The initial and final points are fixed and the second and second to
+        last control points move linearly with tf (through the initial and
+        final speeds), so the reshaped vector is y = yBase + tf*dydtf before
+        the free control points are scattered in using the precomputed flat
+        indices, freeIdx. The same indices gather a Jacobian w.r.t. y back
+        onto x. This is done once, the first time a vector is reshaped, so
+        that the optimizer's calls only copy arrays.
         """
         dim = self.model['dim']
         deg = self.model['deg']
         numVeh = self.model['numVeh']
-        tf = self.model['tf']
         initPoints = self.model['initPoints']
         finalPoints = self.model['finalPoints']
         initSpeeds = self.model['initSpeeds']
@@ -253,36 +461,70 @@ class BezOptimization:
         initAngs = self.model['initAngs']
         finalAngs = self.model['finalAngs']
 
-        numCols = self._numCols
-        numRows = dim*self.model['numVeh']
-
-        # If we are optimizing time, grab the last element which is tf
-        if self.model['minGoal'].lower() == 'timeopt':
-            tf = x[-1]
-            x = x[:-1]
-
-        y = np.empty((dim*numVeh, deg+1))
+        yBase = np.zeros((numVeh, dim, deg+1))
+        dydtf = np.zeros((numVeh, dim, deg+1))
         offset = 0
 
         if initPoints is not None:
             offset += 1
-            for i in range(initPoints.shape[0]):
-                y[i*dim:(i+1)*dim, 0] = initPoints[i]
-                y[i*dim:(i+1)*dim, -1] = finalPoints[i]
+            yBase[:, :, 0] = initPoints
+            yBase[:, :, -1] = finalPoints
 
         if initSpeeds[0] is not None:
             offset += 1
 
-            initMag = initSpeeds*tf/deg
-            finalMag = finalSpeeds*tf/deg
-            y[::2, 1] = initPoints[:, 0] + initMag*np.cos(initAngs)       # X
-            y[1::2, 1] = initPoints[:, 1] + initMag*np.sin(initAngs)      # Y
-            y[::2, -2] = finalPoints[:, 0] - finalMag*np.cos(finalAngs)   # X
-            y[1::2, -2] = finalPoints[:, 1] - finalMag*np.sin(finalAngs)  # Y
+            yBase[:, :, 1] = yBase[:, :, 0]
+            yBase[:, :, -2] = yBase[:, :, -1]
+            dydtf[:, 0, 1] = initSpeeds*np.cos(initAngs)/deg        # X
+            dydtf[:, 1, 1] = initSpeeds*np.sin(initAngs)/deg        # Y
+            dydtf[:, 0, -2] = -finalSpeeds*np.cos(finalAngs)/deg    # X
+            dydtf[:, 1, -2] = -finalSpeeds*np.sin(finalAngs)/deg    # Y
+
+        freeMask = np.zeros(yBase.shape, dtype=bool)
+        freeMask[:, :, offset:deg+1-offset] = True
+
+        self._yBase = yBase
+        self._dydtf = dydtf
+        self._freeIdx = np.flatnonzero(freeMask)
+        self._timeOpt = self.model['minGoal'].lower() == 'timeopt'
+
+    def _chainRule(self, x, jacY, dgdtf=None):
+        """Maps a Jacobian taken w.r.t. the reshaped vector onto x
+
+        The free control points are simply copied out of the reshaped vector
+        so their columns are pulled straight from jacY. When optimizing time,
+        the final time also moves the second and second to last control points
+        (through the initial and final speeds) in addition to any direct
+        dependence, dgdtf, that the function has on tf.
+
+        :param x: Optimization vector
+        :type x: numpy.ndarray
+        :param jacY: Jacobian of the function w.r.t. the reshaped vector. The
+            shape is M x R x dim x (deg+1) where M is the number of outputs
+            and R is at least numVeh. Any extra vehicles (e.g. obstacles) are
+            ignored.
+        :type jacY: numpy.ndarray
+        :param dgdtf: Partial derivative of the function w.r.t. tf while
+            holding the reshaped vector constant. None if there is no direct
+            dependence.
+        :type dgdtf: numpy.ndarray or None
+        :return: Jacobian of the function w.r.t. x, M x len(x)
+        :rtype: numpy.ndarray
+        """
+        if self._yBase is None:
+            self._processModel()
 
-        y[:, offset:-offset] = x.reshape((numRows, numCols))
+        jacY = jacY[:, :self.model['numVeh']]
+        jac = np.take(jacY.reshape((jacY.shape[0], -1)), self._freeIdx, axis=1)
 
-        return y
+        if self._timeOpt:
+            jacTf = np.einsum('mvdc,vdc->m', jacY, self._dydtf)
+            if dgdtf is not None:
+                jacTf += dgdtf
+
+            jac = np.hstack((jac, jacTf[:, np.newaxis]))
+
+        return jac
 
     def euclideanObjective(self, x):
         """
@@ -307,39 +549,75 @@ class BezOptimization:
                                  self.model['dim'],
                                  self.model['tf'])
 
+    def euclideanObjectiveGrad(self, x):
+        """
+        """
+        return self.euclideanObjectiveAndGrad(x)[1]
+
+    def accelObjectiveGrad(self, x):
+        """
+        """
+        return self.accelObjectiveAndGrad(x)[1]
+
+    def jerkObjectiveGrad(self, x):
+        """
+        """
+        return self.jerkObjectiveAndGrad(x)[1]
+
+    def euclideanObjectiveAndGrad(self, x):
+        """
+        """
+        val, gradY = _euclideanObjectiveAndGrad(self.reshapeVector(x),
+                                                self.model['numVeh'],
+                                                self.model['dim'])
+        return val, self._chainRule(x, gradY[np.newaxis])[0]
+
+    def accelObjectiveAndGrad(self, x):
+        """
+        """
+        val, gradY = _minDerivObjectiveAndGrad(self.reshapeVector(x),
+                                               self.model['numVeh'],
+                                               self.model['dim'],
+                                               self.model['tf'],
+                                               2)
+        return val, self._chainRule(x, gradY[np.newaxis])[0]
+
+    def jerkObjectiveAndGrad(self, x):
+        """
+        """
+        val, gradY = _minDerivObjectiveAndGrad(self.reshapeVector(x),
+                                               self.model['numVeh'],
+                                               self.model['dim'],
+                                               self.model['tf'],
+                                               3)
+        return val, self._chainRule(x, gradY[np.newaxis])[0]
+
 
 def _temporalSeparationConstraints(y, nVeh, dim, maxSep):
     """Calculate the separation between vehicles.
 
-    The maximum separation is found by degree elevation.
-
-    NOTE: This only works for 2 dimensions.
+    The maximum separation is found by degree elevation. Any point obstacles
+    are appended to y after the vehicles and are only separated from the
+    vehicles, not from each other, since the distances between obstacles are
+    constant.
 
-    :param x: Optimization vector
-    :type x: numpy.ndarray
-    :param nVeh: Number of vehicles
+    :param y: Optimization vector that has been reshaped using the
+        reshapeVector function, followed by any obstacles.
+    :type y: numpy.ndarray
+    :param nVeh: Number of vehicles, not including the obstacles
     :type nVeh: int
     :param dim: Dimension of the vehicles. Currently only works for 2D
     :type dim: int
     :param maxSep: Maximum separation between vehicles.
     :type maxSep: float
     """
-    if nVeh > 1:
-        distVeh = []
-        vehList = []
+    if y.shape[0] > 1:
+        deg = y.shape[-1] - 1
+        distances = _temporalSeparationKernel(y, nVeh, dim,
+                                              _normSquareElevMatrix(deg),
+                                              float(maxSep))
 
-        for i in range(nVeh):
-            vehList.append(bez.Bezier(y[i*dim:(i+1)*dim, :]))
-
-        for i in range(nVeh):
-            for j in range(i, nVeh):
-                if j > i:
-                    dv = vehList[i] - vehList[j]
-                    distVeh.append(dv.normSquare().elev(DEG_ELEV))
-
-        distances = np.concatenate([i.cpts.squeeze() for i in distVeh])
-
-        return (distances - maxSep**2).squeeze()
+        return distances.squeeze()
 
     else:
         return None
@@ -363,22 +641,10 @@ def _minSpeedConstraints(y, nVeh, dim, tf, minSpeed):
     :return: Inequality constraint for the minimum speed.
     :rtype: float
     """
-#    y = reshapeVector(x, nVeh, dim, model)
-#    if model['type'].lower() == 'timeopt':
-#        tf = x[-1]
-#    else:
-#        tf = model['tf']
-
-    speeds = []
-
-    for i in range(nVeh):
-        pos = bez.Bezier(y[i*dim:i*dim+dim, :], tf=tf)
-        speed = pos.diff()
-        speeds.append(speed)
-
-    speedSqr = [curve.normSquare().elev(DEG_ELEV) for curve in speeds]
-
-    speeds = np.concatenate([i.cpts.squeeze() for i in speedSqr])
+    deg = y.shape[-1] - 1
+    speeds = _speedSqrKernel(y, nVeh, dim,
+                             _diffElevMatrix(deg, tf),
+                             _normSquareElevMatrix(deg))
 
     return (speeds - minSpeed**2).squeeze()
 
@@ -401,22 +667,10 @@ def _maxSpeedConstraints(y, nVeh, dim, tf, maxSpeed):
     :return: Inequality constraint for the maximum speed
     :rtype: float
     """
-#    y = reshapeVector(x, nVeh, dim, model)
-#    if model['type'].lower() == 'timeopt':
-#        tf = x[-1]
-#    else:
-#        tf = model['tf']
-
-    speeds = []
-
-    for i in range(nVeh):
-        pos = bez.Bezier(y[i*dim:i*dim+dim, :], tf=tf)
-        speed = pos.diff()
-        speeds.append(speed)
-
-    speedSqr = [curve.normSquare().elev(DEG_ELEV) for curve in speeds]
-
-    speeds = np.concatenate([i.cpts.squeeze() for i in speedSqr])
+    deg = y.shape[-1] - 1
+    speeds = _speedSqrKernel(y, nVeh, dim,
+                             _diffElevMatrix(deg, tf),
+                             _normSquareElevMatrix(deg))
 
     return (maxSpeed**2 - speeds).squeeze()
 
@@ -440,25 +694,24 @@ def _maxAngularRateConstraints(y, nVeh, dim, tf, maxAngRate):
     :return: Inequality constraint for the maximum angular rate
     :rtype: float
     """
-#    y = reshapeVector(x, nVeh, dim, model)
-#    if model['type'].lower() == 'timeopt':
-#        tf = x[-1]
-#    else:
-#        tf = model['tf']
+    if dim != 2:
+        msg = ('The input curve must be two dimensional,\n'
+               'instead it is {} dimensional'.format(dim))
+        raise ValueError(msg)
 
-    angularRates = []
-    for i in range(nVeh):
-        pos = bez.Bezier(y[i*dim:i*dim+dim, :], tf=tf)
-        angRate = _angularRateSqr(pos.elev(DEG_ELEV))
-        angularRates.append(angRate)
+    deg = y.shape[-1] - 1
+    velMat, accMat = _angularRateMatrices(deg)
+    velMat = velMat / tf
+    accMat = accMat / tf**2
 
-    angularRateCpts = np.concatenate(
-            [i.cpts.squeeze() for i in angularRates])
+    angularRateCpts = _angularRateSqrKernel(y, nVeh, velMat, accMat,
+                                            _productMatrix(deg+DEG_ELEV),
+                                            _productMatrix(2*(deg+DEG_ELEV)))
 
     return (maxAngRate**2 - angularRateCpts).squeeze()
 
 
-@njit(cache=True)
+@njit(cache=True, fastmath=True, nogil=True)
 def _euclideanObjective(y, nVeh, dim):
     """Sums the Euclidean distance between control points.
 
@@ -477,11 +730,11 @@ def _euclideanObjective(y, nVeh, dim):
     """
     summation = 0.0
     temp = np.zeros(3)
-    length = y.shape[1]
+    length = y.shape[2]
     for veh in range(nVeh):
         for i in range(length-1):
             for j in range(dim):
-                temp[j] = y[veh*dim+j, i+1] - y[veh*dim+j, i]
+                temp[j] = y[veh, j, i+1] - y[veh, j, i]
 
             summation += np.linalg.norm(temp)
 
@@ -491,43 +744,163 @@ def _euclideanObjective(y, nVeh, dim):
 def _minAccelObjective(y, nVeh, dim, tf):
     """
     """
-    curves = []
+    deg = y.shape[-1] - 1
+    accelMat = _diffElevMatrix(deg, tf, 2)
+    return _speedSqrKernel(y, nVeh, dim,
+                           accelMat,
+                           _normSquareElevMatrix(deg)).sum()
+
+
+def _minJerkObjective(y, nVeh, dim, tf):
+    """
+    """
+    deg = y.shape[-1] - 1
+    jerkMat = _diffElevMatrix(deg, tf, 3)
+    return _speedSqrKernel(y, nVeh, dim,
+                           jerkMat,
+                           _normSquareElevMatrix(deg)).sum()
+
+
+@njit(cache=True, fastmath=True, nogil=True)
+def _temporalSeparationKernel(y, nVeh, dim, normSqrElevMat, maxSep):
+    """Elevated squared distances between each pair of vehicles and between
+    each vehicle and obstacle
+
+    :param y: Optimization vector that has been reshaped using the
+        reshapeVector function, followed by any obstacles.
+    :type y: numpy.ndarray
+    :param nVeh: Number of vehicles, not including the obstacles
+    :type nVeh: int
+    :param dim: Dimension of the vehicles
+    :type dim: int
+    :param normSqrElevMat: Matrix from _normSquareElevMatrix
+    :type normSqrElevMat: numpy.ndarray
+    :param maxSep: Maximum separation between vehicles.
+    :type maxSep: float
+    :return: Control points of the squared distances minus maxSep^2 for each
+        pair, concatenated.
+    :rtype: numpy.ndarray
+    """
+    numTotal, _, N = y.shape
+    numPairs = nVeh*(nVeh-1)//2 + nVeh*(numTotal-nVeh)
+
+    # Stack the outer products of every pair's difference so that the squared
+    # distances are found with a single matrix product
+    outerProds = np.zeros((numPairs, N*N))
+    dv = np.empty(N)
+    idx = 0
     for i in range(nVeh):
-        pos = bez.Bezier(y[i*dim:i*dim+dim, :], tf=tf)
-        vel = pos.diff()
+        for j in range(i+1, numTotal):
+            for d in range(dim):
+                for a in range(N):
+                    dv[a] = y[i, d, a] - y[j, d, a]
+                for a in range(N):
+                    for b in range(N):
+                        outerProds[idx, a*N+b] += dv[a]*dv[b]
+            idx += 1
 
-        accel = vel.diff()
-        curves.append(accel)
+    distances = np.dot(outerProds, normSqrElevMat)
 
-    summation = 0.0
-    for curve in curves:
-        temp = curve.normSquare().elev(DEG_ELEV)
-        summation = summation + temp.cpts.sum()
+    return distances.ravel() - maxSep*maxSep
 
-    return summation
 
+@njit(cache=True, fastmath=True, nogil=True)
+def _speedSqrKernel(y, nVeh, dim, diffMat, normSqrElevMat):
+    """Elevated norm squared of a derivative of each vehicle's trajectory
 
-@njit(cache=True)
-def _minJerkObjective(y, nVeh, dim, tf):
+    :param y: Optimization vector that has been reshaped using the
+        reshapeVector function.
+    :type y: numpy.ndarray
+    :param nVeh: Number of vehicles
+    :type nVeh: int
+    :param dim: Dimension of the vehicles
+    :type dim: int
+    :param diffMat: Matrix that maps the control points onto the derivative,
+        see _diffElevMatrix.
+    :type diffMat: numpy.ndarray
+    :param normSqrElevMat: Matrix from _normSquareElevMatrix
+    :type normSqrElevMat: numpy.ndarray
+    :return: Control points of the squared speed of each vehicle,
+        concatenated.
+    :rtype: numpy.ndarray
     """
+    numCpts = normSqrElevMat.shape[1]
+    speeds = np.empty(nVeh*numCpts)
+
+    for i in range(nVeh):
+        vel = np.dot(y[i], diffMat)
+        speeds[i*numCpts:(i+1)*numCpts] = _normSquareElev(vel, normSqrElevMat)
+
+    return speeds
+
+
+@njit(cache=True, fastmath=True, nogil=True)
+def _angularRateSqrKernel(y, nVeh, velMat, accMat, prodMat, prodMat2):
+    """Control points of the squared angular rate of each 2D vehicle
+
+    Equivalent to calling _angularRateSqr on each vehicle's elevated
+    trajectory.
+
+    :param y: Optimization vector that has been reshaped using the
+        reshapeVector function.
+    :type y: numpy.ndarray
+    :param nVeh: Number of vehicles
+    :type nVeh: int
+    :param velMat: Matrix mapping the control points onto the elevated
+        velocity.
+    :type velMat: numpy.ndarray
+    :param accMat: Matrix mapping the control points onto the elevated
+        acceleration.
+    :type accMat: numpy.ndarray
+    :param prodMat: Product matrix for curves of the elevated degree
+    :type prodMat: numpy.ndarray
+    :param prodMat2: Product matrix for curves of twice the elevated degree
+    :type prodMat2: numpy.ndarray
+    :return: Control points of the squared angular rates, concatenated.
+    :rtype: numpy.ndarray
     """
-    curves = []
+    numCpts = prodMat2.shape[1]
+    angRates = np.empty(nVeh*numCpts)
+
     for i in range(nVeh):
-        pos = bez.Bezier(y[i*dim:i*dim+dim, :], tf=tf)
-        vel = pos.diff()
+        xDot = np.dot(y[i, 0], velMat)
+        yDot = np.dot(y[i, 1], velMat)
+        xDdot = np.dot(y[i, 0], accMat)
+        yDdot = np.dot(y[i, 1], accMat)
 
-        jerk = vel.diff().diff()
-        curves.append(jerk)
+        numerator = (_bezMul(yDdot, xDot, prodMat) -
+                     _bezMul(xDdot, yDot, prodMat))
+        numerator = _bezMul(numerator, numerator, prodMat2)
+        denominator = (_bezMul(xDot, xDot, prodMat) +
+                       _bezMul(yDot, yDot, prodMat))
+        denominator = _bezMul(denominator, denominator, prodMat2)
 
-    summation = 0.0
-    for curve in curves:
-        temp = curve.normSquare().elev(DEG_ELEV)
-        summation = summation + temp.cpts.sum()
+        angRates[i*numCpts:(i+1)*numCpts] = numerator / denominator
+
+    return angRates
+
+
+@njit(cache=True, fastmath=True, nogil=True)
+def _normSquareElev(cpts, normSqrElevMat):
+    """Elevated norm squared of a curve given its control points
+    """
+    dim, N = cpts.shape
+    xaug = np.zeros(N*N)
+    for d in range(dim):
+        for a in range(N):
+            for b in range(N):
+                xaug[a*N+b] += cpts[d, a]*cpts[d, b]
+
+    return np.dot(xaug, normSqrElevMat)
 
-    return summation
+
+@njit(cache=True, fastmath=True, nogil=True)
+def _bezMul(a, b, prodMat):
+    """Product of two 1D Bezier curves of the same degree
+    """
+    return np.dot(np.outer(a, b).ravel(), prodMat)
 
 
-@jit(cache=True)
 def _angularRate(bezTraj):
     """
     Finds the angular rate of the 2D Bezier Curve.
@@ -599,6 +972,388 @@ def _angularRateSqr(bezTraj):
     return bez.RationalBezier(cpts, weights)
 
 
+def finiteDiffJacobian(fun, x, eps=np.sqrt(np.finfo(float).eps),
+                       executor=None):
+    """Forward difference Jacobian of a function of the optimization vector
+
+    Used for constraints without an analytic Jacobian, such as the spatial
+    separation constraints. The len(x)+1 function evaluations are independent
+    so they can be spread across the workers of a concurrent.futures
+    executor. When using a ProcessPoolExecutor, fun must be picklable, e.g. a
+    BezOptimization method rather than a lambda.
+
+    :param fun: Function of the optimization vector returning a scalar or a
+        1D array.
+    :type fun: callable
+    :param x: Optimization vector
+    :type x: numpy.ndarray
+    :param eps: Relative step size
+    :type eps: float
+    :param executor: Executor used to evaluate the perturbed vectors. If None,
+        they are evaluated serially.
+    :type executor: concurrent.futures.Executor or None
+    :return: Jacobian of fun w.r.t. x, M x len(x)
+    :rtype: numpy.ndarray
+    """
+    x = np.asarray(x, dtype=float)
+    steps = eps*np.maximum(1.0, np.abs(x))
+    points = np.vstack((x, x + np.diag(steps)))
+
+    if executor is None:
+        values = map(fun, points)
+    else:
+        values = executor.map(fun, points)
+
+    values = np.array([np.atleast_1d(val) for val in values])
+    jac = (values[1:] - values[0]) / steps[:, np.newaxis]
+
+    return jac.T
+
+
+def _temporalSeparationConstraintsJac(y, nVeh, dim):
+    """Jacobian of the temporal separation constraints.
+
+    Each constraint is a control point of the elevated squared distance
+    between two vehicles so the Jacobian w.r.t. the first vehicle is the
+    negative of the Jacobian w.r.t. the second. All of the pairs are
+    differentiated at once, in the same order as _temporalSeparationKernel.
+
+    :param y: Optimization vector that has been reshaped using the
+        reshapeVector function, followed by any obstacles.
+    :type y: numpy.ndarray
+    :param nVeh: Number of vehicles, not including the obstacles
+    :type nVeh: int
+    :param dim: Dimension of the vehicles
+    :type dim: int
+    :return: Jacobian w.r.t. y, including the obstacles,
+        M x len(y) x dim x (deg+1)
+    :rtype: numpy.ndarray
+    """
+    numTotal = y.shape[0]
+    deg = y.shape[-1] - 1
+    elevMat = _elevMatrix(2*deg, DEG_ELEV)
+
+    first, second = np.triu_indices(numTotal, 1)
+    isVehPair = first < nVeh
+    first = first[isVehPair]
+    second = second[isVehPair]
+    pairs = np.arange(first.size)
+    pairJac = _normSquareJac(y[first] - y[second],
+                             np.eye(deg+1),
+                             elevMat)
+
+    jac = np.zeros((pairs.size, numTotal) + pairJac.shape[1:])
+    jac[pairs, first] = pairJac
+    jac[pairs, second] = -pairJac
+
+    return _flattenJac(jac)
+
+
+def _speedSqrJac(y, nVeh, dim, tf):
+    """Jacobian of the elevated squared speed used by the speed constraints.
+
+    Since the speed is proportional to 1/tf, the squared speed has the partial
+    derivative -2*speed^2/tf w.r.t. the final time.
+
+    :param y: Optimization vector that has been reshaped using the
+        reshapeVector function.
+    :type y: numpy.ndarray
+    :param nVeh: Number of vehicles
+    :type nVeh: int
+    :param dim: Dimension of the vehicles
+    :type dim: int
+    :param tf: Final time of the trajectories
+    :type tf: float
+    :return: Tuple containing the Jacobian w.r.t. y, M x nVeh x dim x (deg+1),
+        and the partial derivative w.r.t. tf, M.
+    :rtype: tuple(numpy.ndarray, numpy.ndarray)
+    """
+    deg = y.shape[-1] - 1
+    diffMat = _diffElevMatrix(deg, tf)
+    elevMat = _elevMatrix(2*deg, DEG_ELEV)
+
+    vehJac = _normSquareJac(y, diffMat, elevMat)
+    speedSqr = _speedSqrKernel(y, nVeh, dim, diffMat,
+                               _normSquareElevMatrix(deg))
+
+    return _blockDiagJac(vehJac), -2*speedSqr/tf
+
+
+def _angularRateSqrJac(y, nVeh, dim, tf):
+    """Jacobian of the squared angular rate control points.
+
+    Forward mode differentiation of _angularRateSqr. Every intermediate curve
+    is carried along with its Jacobian w.r.t. the vehicle's control points and
+    products follow the usual product rule. The vehicles are differentiated
+    simultaneously. The squared angular rate scales with 1/tf^2 so its
+    partial derivative w.r.t. the final time is -2*angRate^2/tf.
+
+    :param y: Optimization vector that has been reshaped using the
+        reshapeVector function.
+    :type y: numpy.ndarray
+    :param nVeh: Number of vehicles
+    :type nVeh: int
+    :param dim: Dimension of the vehicles. Must be 2.
+    :type dim: int
+    :param tf: Final time of the trajectories
+    :type tf: float
+    :return: Tuple containing the Jacobian w.r.t. y, M x nVeh x dim x (deg+1),
+        and the partial derivative w.r.t. tf, M.
+    :rtype: tuple(numpy.ndarray, numpy.ndarray)
+    """
+    if dim != 2:
+        msg = ('The input curve must be two dimensional,\n'
+               'instead it is {} dimensional'.format(dim))
+        raise ValueError(msg)
+
+    deg = y.shape[-1] - 1
+    velMat, accMat = _angularRateMatrices(deg)
+    velMat = velMat / tf
+    accMat = accMat / tf**2
+    zeros = np.zeros_like(velMat)
+
+    # Curves are stored as nVeh x K where K is the number of control points and
+    # their Jacobians as nVeh x 2(deg+1) x K. The derivatives of the position
+    # are linear so their Jacobians are the same for every vehicle.
+    xDot = np.dot(y[:, 0], velMat)
+    yDot = np.dot(y[:, 1], velMat)
+    xDdot = np.dot(y[:, 0], accMat)
+    yDdot = np.dot(y[:, 1], accMat)
+    xDotJac = np.vstack((velMat, zeros))[np.newaxis]
+    yDotJac = np.vstack((zeros, velMat))[np.newaxis]
+    xDdotJac = np.vstack((accMat, zeros))[np.newaxis]
+    yDdotJac = np.vstack((zeros, accMat))[np.newaxis]
+
+    num, numJac = _dualSub(*_dualMul(yDdot, yDdotJac, xDot, xDotJac),
+                           *_dualMul(xDdot, xDdotJac, yDot, yDotJac))
+    num, numJac = _dualMul(num, numJac, num, numJac)
+
+    den, denJac = _dualAdd(*_dualMul(xDot, xDotJac, xDot, xDotJac),
+                           *_dualMul(yDot, yDotJac, yDot, yDotJac))
+    den, denJac = _dualMul(den, denJac, den, denJac)
+
+    angRateSqr = num / den
+    vehJac = (numJac - angRateSqr[:, np.newaxis, :]*denJac) / \
+        den[:, np.newaxis, :]
+    vehJac = vehJac.transpose((0, 2, 1)).reshape(
+            (nVeh, num.shape[1], dim, deg+1))
+
+    return _blockDiagJac(vehJac), -2*angRateSqr.ravel()/tf
+
+
+def _euclideanObjectiveAndGrad(y, nVeh, dim):
+    """Euclidean objective and its gradient w.r.t. the reshaped vector.
+
+    The segment lengths are needed for both the objective and the unit vectors
+    of the gradient so they are computed only once.
+
+    :param y: Optimization vector that has been reshaped using the
+        reshapeVector function.
+    :type y: numpy.ndarray
+    :param nVeh: Number of vehicles
+    :type nVeh: int
+    :param dim: Dimension of the vehicles
+    :type dim: int
+    :return: Tuple containing the sum of the Euclidean distances and the
+        gradient w.r.t. y, nVeh x dim x (deg+1)
+    :rtype: tuple(float, numpy.ndarray)
+    """
+    diffs = y[:, :, 1:] - y[:, :, :-1]
+    lengths = np.sqrt((diffs*diffs).sum(axis=1, keepdims=True))
+
+    # The norm is not differentiable at zero, use the zero subgradient
+    units = np.divide(diffs, lengths, out=np.zeros_like(diffs),
+                      where=lengths > 0)
+    grad = np.zeros(y.shape)
+    grad[:, :, 1:] += units
+    grad[:, :, :-1] -= units
+
+    return lengths.sum(), grad
+
+
+def _minDerivObjectiveAndGrad(y, nVeh, dim, tf, order):
+    """Minimum acceleration or jerk objective and its gradient.
+
+    :param y: Optimization vector that has been reshaped using the
+        reshapeVector function.
+    :type y: numpy.ndarray
+    :param nVeh: Number of vehicles
+    :type nVeh: int
+    :param dim: Dimension of the vehicles
+    :type dim: int
+    :param tf: Final time of the trajectories
+    :type tf: float
+    :param order: Order of the derivative being minimized, 2 for the
+        acceleration and 3 for the jerk.
+    :type order: int
+    :return: Tuple containing the objective and the gradient w.r.t. y,
+        nVeh x dim x (deg+1)
+    :rtype: tuple(float, numpy.ndarray)
+    """
+    deg = y.shape[-1] - 1
+    diffMat = _diffElevMatrix(deg, tf, order)
+    elevMat = _elevMatrix(2*deg, DEG_ELEV)
+
+    summation = _speedSqrKernel(y, nVeh, dim, diffMat,
+                                _normSquareElevMatrix(deg)).sum()
+    vehJac = _normSquareJac(y, diffMat, elevMat)
+
+    return summation, vehJac.sum(axis=1)
+
+
+def _normSquareJac(cpts, linMat, elevMat):
+    """Jacobian of the elevated norm squared of a linear map of curves.
+
+    Computes the derivative of normSquare(cpts*linMat)*elevMat w.r.t. cpts.
+    The norm squared is a quadratic form so the derivative w.r.t. cpts[d, a]
+    is twice the product of the a-th row of linMat with the d-th row of the
+    mapped control points.
+
+    :param cpts: Control points of the curves, V x dim x (deg+1)
+    :type cpts: numpy.ndarray
+    :param linMat: Linear map applied to the control points, such as a
+        derivative matrix, (deg+1) x (n+1)
+    :type linMat: numpy.ndarray
+    :param elevMat: Elevation matrix applied to the norm squared,
+        (2n+1) x M
+    :type elevMat: numpy.ndarray
+    :return: Jacobian of each curve, V x M x dim x (deg+1)
+    :rtype: numpy.ndarray
+    """
+    mapped = np.matmul(cpts, linMat)
+    prodTensor = _productTensor(linMat.shape[1]-1)
+    # Contract with the mapped curves first, leaving one matrix per dimension
+    prodMats = np.tensordot(mapped, prodTensor, axes=(-1, 1))
+    partial = np.matmul(linMat, np.matmul(prodMats, elevMat))
+
+    return 2*partial.transpose((0, 3, 1, 2))
+
+
+def _blockDiagJac(vehJac):
+    """Builds a Jacobian from blocks that each depend on a single vehicle
+
+    :param vehJac: Jacobian of each vehicle's outputs w.r.t. its own control
+        points, V x M x dim x (deg+1)
+    :type vehJac: numpy.ndarray
+    :return: Jacobian, V*M x V x dim x (deg+1)
+    :rtype: numpy.ndarray
+    """
+    nVeh = vehJac.shape[0]
+    vehicles = np.arange(nVeh)
+    jac = np.zeros((nVeh,) + vehJac.shape)
+    jac[vehicles, vehicles] = vehJac
+
+    return _flattenJac(jac)
+
+
+def _flattenJac(jac):
+    """Flattens a B x V x M x dim x (deg+1) Jacobian of B blocks of M outputs
+    w.r.t. V vehicles into a B*M x V x dim x (deg+1) Jacobian
+    """
+    numBlocks, nVeh, M, dim, numCpts = jac.shape
+    return jac.transpose((0, 2, 1, 3, 4)).reshape(
+            (numBlocks*M, nVeh, dim, numCpts))
+
+
+def _dualAdd(a, aJac, b, bJac):
+    return a + b, aJac + bJac
+
+
+def _dualSub(a, aJac, b, bJac):
+    return a - b, aJac - bJac
+
+
+def _dualMul(a, aJac, b, bJac):
+    """Products of 1D Bezier curves along with their Jacobians
+
+    The curves have the shape V x K where V is the number of curves and K is
+    the number of control points. The Jacobians have the shape V x Q x K, or
+    1 x Q x K if shared by all curves, where Q is the number of parameters.
+    """
+    prodTensor = _productTensor(a.shape[1]-1)
+    # Multiplying by a fixed curve is linear, i.e. a matrix per curve
+    aMat = np.tensordot(a, prodTensor, axes=(1, 0))
+    bMat = np.tensordot(b, prodTensor, axes=(1, 1))
+
+    prod = np.matmul(a[:, np.newaxis, :], bMat)[:, 0, :]
+    prodJac = np.matmul(aJac, bMat) + np.matmul(bJac, aMat)
+
+    return prod, prodJac
+
+
+@functools.lru_cache(maxsize=None)
+def _elevMatrix(deg, R):
+    """Elevation matrix of a degree deg curve elevated by R
+
+    The matrices only depend on the degree so they are built once and reused
+    for every evaluation. The cached arrays are read only.
+    """
+    return _readOnly(bez.elevMatrix(deg, R))
+
+
+@functools.lru_cache(maxsize=None)
+def _derivElevMatrix(deg, order=1):
+    """Matrix equivalent to applying Bezier.diff order times with tf = 1
+
+    Each derivative is followed by an elevation of 1 so the degree is kept.
+    The derivative w.r.t. time scales with 1/tf so the matrix for a final time
+    of tf is _derivElevMatrix(deg, order) / tf**order. Keeping tf out of the
+    key lets the cache be reused while the final time is being optimized.
+    """
+    diffMat = np.dot(bez.diffMatrix(deg, 1.0), _elevMatrix(deg-1, 1))
+    return _readOnly(np.linalg.matrix_power(diffMat, order))
+
+
+def _diffElevMatrix(deg, tf, order=1):
+    """Matrix equivalent to applying Bezier.diff order times
+    """
+    return _derivElevMatrix(deg, order) / tf**order
+
+
+@functools.lru_cache(maxsize=None)
+def _angularRateMatrices(deg):
+    """Matrices mapping the control points onto the elevated velocity and
+    acceleration used by the angular rate constraints, with tf = 1.
+    """
+    velMat = np.dot(_elevMatrix(deg, DEG_ELEV),
+                    _derivElevMatrix(deg+DEG_ELEV))
+    accMat = np.dot(velMat, _derivElevMatrix(deg+DEG_ELEV))
+
+    return _readOnly(velMat), _readOnly(accMat)
+
+
+@functools.lru_cache(maxsize=None)
+def _productMatrix(deg):
+    """Product matrix of two degree deg curves
+    """
+    return _readOnly(np.ascontiguousarray(bez.bezProductCoefficients(deg)))
+
+
+def _productTensor(deg):
+    """Product coefficients of two degree deg curves as a 3D tensor
+
+    The tensor T is (deg+1) x (deg+1) x (2*deg+1) such that the product of the
+    curves a and b has the control points sum_ij a_i*b_j*T[i, j, :].
+    """
+    return _productMatrix(deg).reshape((deg+1, deg+1, 2*deg+1))
+
+
+@functools.lru_cache(maxsize=None)
+def _normSquareElevMatrix(deg):
+    """Maps the flattened outer product of a curve onto its elevated norm
+    squared, i.e. the product matrix followed by the elevation matrix.
+    """
+    return _readOnly(np.dot(_productMatrix(deg),
+                            _elevMatrix(2*deg, DEG_ELEV)))
+
+
+def _readOnly(arr):
+    """Marks a cached array as read only so it cannot be modified in place
+    """
+    arr.setflags(write=False)
+    return arr
+
+
 if __name__ == '__main__':
     numVeh = 2
     dim = 2
@@ -619,14 +1374,14 @@ if __name__ == '__main__':
     xGuess = bezopt.generateGuess()
 
     x = np.random.randint(0, 10, xLen)
-    cpts1 = bezopt.reshapeVector(x)[:2, :]
-    cpts2 = bezopt.reshapeVector(x)[2:, :]
+    cpts1 = bezopt.reshapeVector(x)[0]
+    cpts2 = bezopt.reshapeVector(x)[1]
 
     print('cpts1:\n{},\ncpts2:\n{}'.format(cpts1, cpts2))
     print('X Guess:\n{}'.format(xGuess))
 
-    c1guess = bez.Bezier(bezopt.reshapeVector(xGuess)[:2, :])
-    c2guess = bez.Bezier(bezopt.reshapeVector(xGuess)[2:, :])
+    c1guess = bez.Bezier(bezopt.reshapeVector(xGuess)[0])
+    c2guess = bez.Bezier(bezopt.reshapeVector(xGuess)[1])
 
     plt.close('all')
     ax1 = c1guess.plot()